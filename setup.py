@@ -35,6 +35,7 @@ setuptools.setup(
         'messy_fediverse.static.messy.fediverse',
         'messy_fediverse.templates',
         'messy_fediverse.templates.messy.fediverse',
+        'messy_fediverse.templates.admin.messy_fediverse.federatedendpoint',
         'messy_fediverse.management.commands'
     ],
     package_data={
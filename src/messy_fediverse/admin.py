@@ -1,9 +1,13 @@
 from django.contrib import admin
-from .models import FederatedEndpoint, Activity, Follower
+from .models import FederatedEndpoint, Activity, Follower, Delivery, Worker, IncomingActivity, RequestHeaders, BlockedDomain
+from django.utils import timezone
 from .controller import fediverse_factory, save_activity, send_accept_follow, add_task
 from .middleware import stderrlog
 from asgiref.sync import sync_to_async, async_to_sync
 import aiohttp
+from urllib.parse import urlparse
+from django.urls import path
+from django.shortcuts import redirect
 # import asyncio
 
 class FollowerAdmin(admin.ModelAdmin):
@@ -41,7 +45,93 @@ class FollowerAdmin(admin.ModelAdmin):
                 form.cleaned_data['accepted'] = False
         
         return super().save_model(request, obj, form, change)
+
+class FederatedEndpointAdmin(admin.ModelAdmin):
+    list_display = ['uri', 'disabled', 'consecutive_failures', 'last_success_at', 'last_latency', 'next_probe_at']
+    list_filter = ['disabled']
+    actions = ['reset_health', 'block_domain']
+    
+    def get_urls(self):
+        return [
+            path(
+                'clear-negative-cache/',
+                self.admin_site.admin_view(self.clear_negative_cache),
+                name='messy_fediverse_clear_negative_cache'
+            ),
+        ] + super().get_urls()
+    
+    def clear_negative_cache(self, request):
+        '''
+        Failed fetches are cached for some time,
+        this allows to retry them right now.
+        Not related to endpoints, button is in endpoints list
+        (templates/admin/messy_fediverse/federatedendpoint/change_list.html).
+        '''
+        if request.method == 'POST' and self.has_change_permission(request):
+            fediverse = fediverse_factory(request)
+            fediverse.clear_negative_cache()
+            stats = fediverse.stats['aget']
+            self.message_user(request, f'Cached failures cleared. Hits: {stats["negative_hits"]}, stored: {stats["negative_sets"]} (this process).')
+        return redirect('admin:messy_fediverse_federatedendpoint_changelist')
     
-admin.site.register(FederatedEndpoint)
+    @admin.action(description='Reset health stats and enable')
+    def reset_health(self, request, queryset):
+        '''
+        Endpoints are disabled automatically if failing for long time.
+        '''
+        updated = queryset.update(disabled=False, consecutive_failures=0, failing_since=None, next_probe_at=None)
+        self.message_user(request, f'Endpoints reset: {updated}.')
+
+    @admin.action(description='Block domains of endpoints')
+    def block_domain(self, request, queryset):
+        blocked = 0
+        for endpoint in queryset:
+            host = urlparse(endpoint.uri).hostname
+            if host:
+                _, created = BlockedDomain.objects.get_or_create(domain=host.lower())
+                blocked += int(created)
+        queryset.update(disabled=True)
+        self.message_user(request, f'Domains blocked: {blocked}.')
+
+class BlockedDomainAdmin(admin.ModelAdmin):
+    list_display = ['domain', 'subdomains', 'created_at', 'reason']
+    search_fields = ['domain']
+
+class DeliveryAdmin(admin.ModelAdmin):
+    raw_id_fields = ['activity']
+    list_display = ['inbox', 'status', 'attempts', 'next_attempt_at', 'last_attempt_at', 'activity']
+    list_filter = ['status']
+    search_fields = ['inbox']
+    actions = ['retry_now']
+    
+    @admin.action(description='Retry now')
+    def retry_now(self, request, queryset):
+        updated = queryset.exclude(status=Delivery.DELIVERED).update(status=Delivery.PENDING, next_attempt_at=timezone.now())
+        self.message_user(request, f'Deliveries queued: {updated}.')
+
+class IncomingActivityAdmin(admin.ModelAdmin):
+    list_display = ['uri', 'status', 'attempts', 'received_at']
+    list_filter = ['status']
+    search_fields = ['uri']
+    actions = ['retry_now']
+    
+    @admin.action(description='Retry now')
+    def retry_now(self, request, queryset):
+        updated = queryset.filter(status=IncomingActivity.FAILED).update(status=IncomingActivity.QUEUED)
+        self.message_user(request, f'Activities queued: {updated}.')
+
+class RequestHeadersAdmin(admin.ModelAdmin):
+    list_display = ['uri', 'received_at']
+    search_fields = ['uri']
+
+class WorkerAdmin(admin.ModelAdmin):
+    list_display = ['worker_id', 'started_at', 'heartbeat_at', 'stopped_at', 'activities_done', 'deliveries_done', 'delivery_lag']
+
+admin.site.register(FederatedEndpoint, FederatedEndpointAdmin)
 admin.site.register(Activity)
 admin.site.register(Follower, FollowerAdmin)
+admin.site.register(BlockedDomain, BlockedDomainAdmin)
+admin.site.register(Delivery, DeliveryAdmin)
+admin.site.register(IncomingActivity, IncomingActivityAdmin)
+admin.site.register(RequestHeaders, RequestHeadersAdmin)
+admin.site.register(Worker, WorkerAdmin)
@@ -0,0 +1,32 @@
+class LifespanMiddleware:
+    '''
+    ASGI middleware handling lifespan events,
+    Django doesn't support them.
+    Closes HTTP sessions on shutdown.
+    
+    Usage in your asgi.py:
+        from django.core.asgi import get_asgi_application
+        from messy_fediverse.asgi import LifespanMiddleware
+        application = LifespanMiddleware(get_asgi_application())
+    '''
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await self.app(scope, receive, send)
+        
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    ## Lazy import, apps may be not loaded yet on import
+                    from .controller import close_sessions
+                    await close_sessions()
+                except BaseException as e:
+                    await send({'type': 'lifespan.shutdown.failed', 'message': repr(e)})
+                else:
+                    await send({'type': 'lifespan.shutdown.complete'})
+                return
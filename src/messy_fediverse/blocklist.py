@@ -0,0 +1,111 @@
+'''
+Blocked domains.
+'''
+import asyncio
+from time import monotonic
+from urllib.parse import urlparse
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from .transport import DomainTrie
+from .models import BlockedDomain
+from .log import log_failure
+
+class DomainBlocklist:
+    '''
+    Domains from settings and BlockedDomain model, kept in memory.
+    Reloaded from database every ttl seconds.
+    '''
+    def __init__(self, domains=(), ttl=60):
+        '''
+        domains: list of always blocked domains (from settings)
+        ttl: int, seconds between reloads
+        '''
+        self.domains = list(domains)
+        self.ttl = ttl
+        self.trie = DomainTrie(self.domains)
+        self._loaded_at = None
+        self._loading = None
+        self.stats = {
+            'blocked': 0,
+            'reloads': 0,
+        }
+    
+    def load(self):
+        trie = DomainTrie(self.domains)
+        for domain, subdomains in BlockedDomain.objects.values_list('domain', 'subdomains'):
+            trie.add(domain, subdomains)
+        return trie
+    
+    def is_stale(self):
+        return self._loaded_at is None or monotonic() - self._loaded_at > self.ttl
+    
+    async def refresh(self):
+        '''
+        Reload domains if needed.
+        '''
+        if not self.is_stale():
+            return
+        if self._loading is None or self._loading.get_loop() is not asyncio.get_running_loop():
+            self._loading = asyncio.ensure_future(self._reload())
+        await asyncio.shield(self._loading)
+    
+    async def _reload(self):
+        try:
+            self.trie = await sync_to_async(self.load)()
+            self.stats['reloads'] += 1
+        except Exception as e:
+            ## Keeping old domains, will retry after ttl
+            log_failure('Loading blocked domains', e)
+        finally:
+            self._loaded_at = monotonic()
+            self._loading = None
+    
+    def is_blocked(self, host):
+        '''
+        Checks if host is blocked.
+        Domains are loaded in background if stale,
+        or right away if called outside of event loop.
+        '''
+        if self.is_stale():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is None:
+                self.trie = self.load()
+                self._loaded_at = monotonic()
+                self.stats['reloads'] += 1
+            elif self._loading is None or self._loading.get_loop() is not loop:
+                self._loading = loop.create_task(self._reload())
+        
+        if self.trie.match(host):
+            self.stats['blocked'] += 1
+            return True
+        return False
+    
+    def is_blocked_url(self, url):
+        if type(url) is not str:
+            return False
+        try:
+            return self.is_blocked(urlparse(url).hostname)
+        except ValueError:
+            return False
+
+__blocklist__ = None
+
+def domain_blocklist():
+    '''
+    Get DomainBlocklist with domains from MESSY_FEDIVERSE['BLOCKED_DOMAINS']
+    and BlockedDomain model, reloaded every BLOCKED_DOMAINS_TTL seconds.
+    '''
+    global __blocklist__
+    if __blocklist__ is None:
+        __blocklist__ = DomainBlocklist(
+            domains=(
+                list(settings.MESSY_FEDIVERSE.get('BLOCKED_DOMAINS', ()))
+                ## Older name of setting
+                + list(settings.MESSY_FEDIVERSE.get('INBOX_BLOCKED_DOMAINS', ()))
+            ),
+            ttl=settings.MESSY_FEDIVERSE.get('BLOCKED_DOMAINS_TTL', 60)
+        )
+    return __blocklist__
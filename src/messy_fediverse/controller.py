@@ -26,7 +26,10 @@ import sys
 from asgiref.sync import sync_to_async, async_to_sync
 import asyncio
 import aiohttp
-from .models import Activity, Follower, FederatedEndpoint
+from .models import Activity, Follower, FederatedEndpoint, IncomingActivity, RequestHeaders
+from .notify import notify_worker
+from .inbox import recent_activities, request_meta, request_json, is_relay, known_actors, actor_id, own_activity_id
+from .blocklist import domain_blocklist
 # from .middleware import stderrlog
 # from functools import partial
 #from pprint import pprint
@@ -213,7 +216,7 @@ async def email_notice(request, activity):
     ap_object = activity.get('object', {})
     fediverse = fediverse_factory(request)
     
-    if 'actor' in activity and 'relay' in activity['actor']:
+    if is_relay(activity.get('actor')):
         ## FIXME quickfix, temporarily ignoring relayed messages
         return False
     
@@ -367,13 +370,22 @@ def fediverse_factory(request):
             privkey=settings.MESSY_FEDIVERSE['PRIVKEY'],
             pubkey=settings.MESSY_FEDIVERSE['PUBKEY'],
             datadir=settings.MESSY_FEDIVERSE.get('DATADIR', settings.MEDIA_ROOT),
-            debug=settings.DEBUG or settings.MESSY_FEDIVERSE.get('DEBUG', False)
+            debug=settings.DEBUG or settings.MESSY_FEDIVERSE.get('DEBUG', False),
+            options=settings.MESSY_FEDIVERSE
         )
     
     __cache__['fediverse'].federated_endpoints = FederatedEndpoint.objects.filter(disabled=False)
+    __cache__['fediverse'].blocklist = domain_blocklist()
     
     return __cache__['fediverse']
 
+async def close_sessions():
+    '''
+    Close HTTP sessions of actor, should be called on shutdown.
+    '''
+    if 'fediverse' in __cache__:
+        await __cache__['fediverse'].close()
+
 #@csrf_exempt
 async def main(request):
     if is_json_request(request):
@@ -529,6 +541,11 @@ async def save_activity(request, activity_dict):
         activity_id = activity.pk
         if creating:
             created_id = activity_id
+            if incoming:
+                await known_actors().add(activity.actor_uri)
+        if activity.processing_status == 0:
+            ## Worker should process it
+            await notify_worker()
     except BaseException as e:
         trace_msg = traceback.format_exc()
         
@@ -1117,6 +1134,29 @@ class Replies(View):
         
         return {'root': root, 'activities': activities}
 
+async def process_incoming(request, data):
+    '''
+    Saving activity received by inbox, handling follows, sending notices.
+    request: django HttpRequest instance
+    data: dict, activity
+    Returns saved Activity or None.
+    '''
+    fediverse = fediverse_factory(request)
+    tasks = []
+    
+    # result = await fediverse.process_object(data)
+    # data['_json'] = result
+    if 'actor' in data and 'authorInfo' not in data and 'authorInfo' not in data.get('object', {}):
+        data['authorInfo'] = await fediverse.aget(data['actor'])
+    
+    tasks.append(save_activity(request, data))
+    
+    if data.get('type') != 'Delete':
+        tasks.append(email_notice(request, data))
+    
+    tasks = await asyncio.gather(*tasks)
+    return tasks[0]
+
 @method_decorator(csrf_exempt, name='dispatch')
 class Inbox(View):
     async def post(self, request):
@@ -1127,23 +1167,59 @@ class Inbox(View):
         responseData = {'success': False}
         tasks = []
         
+        recent = None
+        activity_id = None
+        
         ## If we've received a JSON
         if is_post_json(request):
-            data = json.loads(request.body)
-            fediverse = fediverse_factory(request)
+            ## Parsed once by middleware already, None if it's not an object
+            data = request_json(request)
+            
+            blocklist = domain_blocklist()
+            await blocklist.refresh()
+            if type(data) is not dict or blocklist.is_blocked_url(actor_id(data)) or blocklist.is_blocked_url(data.get('id')):
+                return JsonResponse({'success': False, 'status': 'rejected'}, status=403)
+            
+            ## Same activity may come to shared and direct inbox and from relays
+            recent = recent_activities()
+            activity_id = data.get('id')
+            if recent is not None and type(activity_id) is str:
+                ## Copies forwarded by relays are signed by relay, so they are
+                ## checked, but only IDs owned by sender are remembered.
+                own = own_activity_id(request, data) is not None
+                if await recent.seen(activity_id, record=own):
+                    return JsonResponse({'success': True, 'status': 'duplicate'})
+                if not own:
+                    recent = None
+            else:
+                recent = None
+            
             if '_requestMeta' not in data:
                 data['_requestMeta'] = {}
-            for k in request.META:
-                if k.startswith('HTTP_'):
-                    data['_requestMeta'][k] = request.META[k]
+            ## Only some headers are stored with activity
+            data['_requestMeta'].update(request_meta(request))
             
-            # result = await fediverse.process_object(data)
-            # data['_json'] = result
-            if 'actor' in data and 'authorInfo' not in data and 'authorInfo' not in data.get('object', {}):
-                data['authorInfo'] = await fediverse.aget(data['actor'])
+            if settings.MESSY_FEDIVERSE.get('INBOX_DEBUG_HEADERS', False):
+                await RequestHeaders.objects.acreate(
+                    uri=str(activity_id or '')[:255],
+                    headers=request_meta(request, '*')
+                )
+            
+            if settings.MESSY_FEDIVERSE.get('INBOX_QUEUE', False):
+                ## Signature is already verified by middleware,
+                ## the rest is done by worker.
+                try:
+                    await IncomingActivity.objects.acreate(uri=str(activity_id or '')[:255], data=data)
+                except BaseException:
+                    ## Let remote server retry
+                    if recent is not None:
+                        await recent.forget(activity_id)
+                    raise
+                await notify_worker()
+                return JsonResponse({'success': True, 'status': 'accepted'}, status=202)
             
             should_log_request = False
-            saveResult = save_activity(request, data)
+            saveResult = process_incoming(request, data)
             tasks.append(saveResult)
             
             if 'type' in data and data['type'] == 'Delete':
@@ -1151,15 +1227,18 @@ class Inbox(View):
                 responseData['success'] = True
                 responseData['status'] = 'success'
                 responseData['message'] = "Fuck off, I don't give a fuck what you delete."
-            else:
-                tasks.append(email_notice(request, data))
         
         if should_log_request:
             ## DEBUG
             tasks.append(log_request(request, data))
         
         if len(tasks):
-            tasks = await asyncio.gather(*tasks)
+            try:
+                tasks = await asyncio.gather(*tasks)
+            except BaseException:
+                if recent is not None:
+                    await recent.forget(activity_id)
+                raise
             if saveResult:
                 saveResult = tasks[0]
         
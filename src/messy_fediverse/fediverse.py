@@ -5,6 +5,7 @@ from os import path
 from datetime import datetime
 from random import random
 import json
+from copy import deepcopy
 from urllib.parse import urlparse
 from email import utils as emailutils
 from base64 import b64encode, b64decode
@@ -13,9 +14,14 @@ from hashlib import sha256
 import re
 import syslog
 import sys
+import threading
+import weakref
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from asgiref.sync import sync_to_async, async_to_sync
 from . import html
+from .transport import DeliveryScheduler, LatencyTracker, CircuitBreaker, HostUnavailable, HostBlocked, RateLimited, ResponseTooLarge, parse_retry_after
 import atexit
 from functools import partial
 # import cryptography.exceptions
@@ -25,14 +31,190 @@ from cryptography.hazmat.primitives.asymmetric import padding as crypt_padding
 from cryptography.hazmat.primitives.serialization import load_pem_public_key as crypt_load_pem_public_key
 from cryptography.hazmat.primitives import serialization as crypt_serialization
 
+class SignEngine:
+    '''
+    Keeps parsed private key in memory and makes RSA signatures with it.
+    Signatures may be made in a thread pool, so that large fan-outs
+    don't block event loop.
+    '''
+    def __init__(self, privkey, max_workers=2):
+        '''
+        privkey: string or bytes, PEM encoded private key
+        max_workers: int, threads in signing pool
+        '''
+        self.__privkey__ = privkey
+        self.__key__ = None
+        self.__executor__ = None
+        self.__max_workers__ = max_workers
+        self.__lock__ = threading.Lock()
+        self.stats = {
+            'count': 0,
+            'time_total': 0.0,
+            'time_max': 0.0,
+            'time_avg': 0.0,
+        }
+    
+    @property
+    def key(self):
+        '''Private key object, PEM is parsed only once'''
+        if self.__key__ is None:
+            with self.__lock__:
+                if self.__key__ is None:
+                    self.__key__ = FediverseActor.crypt_load_private_key(self.__privkey__)
+        return self.__key__
+    
+    def sign(self, payload):
+        '''
+        Sign payload.
+        payload: string or bytes
+        Returns base64 encoded signature bytes.
+        '''
+        key = self.key
+        started = perf_counter()
+        result = FediverseActor.crypt_sign(payload, key)
+        elapsed = perf_counter() - started
+        
+        with self.__lock__:
+            self.stats['count'] += 1
+            self.stats['time_total'] += elapsed
+            self.stats['time_max'] = max(self.stats['time_max'], elapsed)
+            self.stats['time_avg'] = self.stats['time_total'] / self.stats['count']
+        
+        return result
+    
+    async def asign(self, payload):
+        '''
+        Async version of sign(), signature is made in a thread pool.
+        '''
+        if self.__executor__ is None:
+            self.__executor__ = ThreadPoolExecutor(
+                max_workers=self.__max_workers__,
+                thread_name_prefix='messy-fediverse-sign'
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor__, self.sign, payload)
+
+class ActorRequest:
+    '''
+    Request returned by FediverseActor.request().
+    It may be used as async context manager or awaited like aiohttp requests.
+    HTTP signature is made when request is started, so signing doesn't
+    happen in event loop thread.
+    '''
+    def __init__(self, actor, session, method, url, *args, **kwargs):
+        self.actor = actor
+        self.session = session
+        self.method = method
+        self.url = url
+        self.hostname = urlparse(url).hostname
+        self.args = args
+        self.kwargs = kwargs
+        self._response_cm = None
+        self._slot = None
+        ## Wait for slot and rate limits of host, otherwise
+        ## don't limit, but fail with RateLimited if host asked to retry later
+        self.wait_rate_limits = actor.wait_rate_limits
+        self.started = None
+        ## Set when finished
+        self.latency = None
+        self.error = None
+    
+    async def _start(self):
+        self.actor.check_host(self.hostname)
+        ## Don't even wait for a slot if host is known to be failing
+        self.actor.breaker.check(self.hostname)
+        if self.wait_rate_limits:
+            ## Waiting for free slot and rate limits of the host
+            self._slot = await self.actor.scheduler.acquire(self.hostname)
+        else:
+            ## Failing at once if host asked to retry later
+            self.actor.scheduler.check(self.hostname)
+        try:
+            ## Updates kwargs with http signature
+            await self.actor.asign_request(self.url, self.method, self.kwargs)
+            self._response_cm = getattr(self.session, self.method)(self.url, *self.args, **self.kwargs)
+        except BaseException:
+            self._done()
+            raise
+        self.started = perf_counter()
+        return self._response_cm
+    
+    def _failed(self, error):
+        self.error = error
+        if self.started is not None:
+            self.actor.on_request_error(self, error, perf_counter() - self.started)
+    
+    def _done(self):
+        if self._slot is not None:
+            self.actor.scheduler.release(self.hostname, self._slot)
+            self._slot = None
+    
+    async def _send(self):
+        try:
+            response = await (await self._start())
+            self.actor.on_response(self, response)
+            return response
+        except BaseException as e:
+            self._failed(e)
+            raise
+        finally:
+            self._done()
+    
+    def __await__(self):
+        return self._send().__await__()
+    
+    async def __aenter__(self):
+        try:
+            response = await (await self._start()).__aenter__()
+        except BaseException as e:
+            self._failed(e)
+            self._done()
+            raise
+        self.actor.on_response(self, response)
+        return response
+    
+    async def __aexit__(self, *exc_info):
+        try:
+            if self._response_cm is not None:
+                return await self._response_cm.__aexit__(*exc_info)
+        finally:
+            self._done()
+
 class FediverseActor:
     __tasks__ = set()
-    __sessions__ = set()
+    ## Instances, to close their sessions at exit
+    __instances__ = weakref.WeakSet()
+    ## Whether requests should be limited by scheduler and wait if host
+    ## asked to retry later (up to DELIVERY_MAX_WAIT), or fail at once.
+    ## Only deliveries and background workers should wait, not HTTP
+    ## request handlers.
+    wait_rate_limits = False
     
-    def __init__(self, user, privkey, pubkey, headers=None, datadir='/tmp', cache=None, debug=False):
+    def __init__(self, user, privkey, pubkey, headers=None, datadir='/tmp', cache=None, debug=False, options=None):
         '''
         :cache object: optional cache object used for caching requests
+        :options dict: optional tuning options (like MESSY_FEDIVERSE settings)
         '''
+        self.__options__ = options or {}
+        ## Per event loop state (HTTP session e.t.c.)
+        self.__loops__ = weakref.WeakKeyDictionary()
+        self.__connection_stats__ = {
+            'sessions': 0,
+            'requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_resolved': 0,
+            'dns_cache_hits': 0,
+        }
+        self.__aget_stats__ = {
+            'cache_hits': 0,
+            'fetches': 0,
+            'coalesced': 0,
+            'negative_hits': 0,
+            'negative_sets': 0,
+            'revalidated': 0,
+            'stale_served': 0,
+        }
         self.__cache__ = cache
         self.__sentinel__ = object()
         self.__headers__ = headers
@@ -41,7 +223,24 @@ class FediverseActor:
         self.__pubkey__ = pubkey
         self.__datadir__ = datadir
         self.__DEBUG__ = debug
+        self.__signer__ = SignEngine(privkey)
+        self.__latency__ = LatencyTracker(maxsize=self.option('HTTP_LATENCY_HOSTS', 4096))
+        self.__breaker__ = CircuitBreaker(
+            threshold=self.option('CIRCUIT_BREAKER_THRESHOLD', 5),
+            cooldown=self.option('CIRCUIT_BREAKER_COOLDOWN', 30.0),
+            max_cooldown=self.option('CIRCUIT_BREAKER_MAX_COOLDOWN', 1800.0),
+        )
         self._rewhitespace = re.compile(r'\s+')
+        self.__instances__.add(self)
+    
+    @classmethod
+    def close_instances(cls):
+        '''
+        Closing sessions left open if there was no proper shutdown.
+        Registered with atexit once for all instances.
+        '''
+        for instance in list(cls.__instances__):
+            instance.close_all()
     
     @classmethod
     def on_task_done(cls, task, *args, **kwargs):
@@ -136,7 +335,14 @@ class FediverseActor:
             key = key.replace('http://', 'https://', 1)
         return key.split('#')[0]
     
-    async def cache_set(self, name, value):
+    async def cache_set(self, name, value, validators=None):
+        '''
+        name: string URL
+        value: data to cache
+        validators: dict with 'etag' and 'lastModified' of response (optional).
+            If set, entry is kept longer than it's fresh and revalidated
+            with conditional request when it gets stale.
+        '''
         if self.__cache__ is not None:
             if hasattr(value, 'result') and callable(value.result):
                 ## For future like objects
@@ -147,12 +353,179 @@ class FediverseActor:
                 ## FIXME cannot reuse already awaited coroutine
             
             name = self.mk_cache_key(name)
+            
+            if validators and type(value) is dict:
+                fresh_ttl = self.option('CACHE_FRESH_TTL', getattr(self.__cache__, 'default_timeout', 300))
+                value = dict(value)
+                value['_validators'] = validators
+                value['_freshUntil'] = datetime.now().timestamp() + fresh_ttl
+                return await self.__cache__.aset(name, value, self.option('CACHE_REVALIDATE_TTL', 86400 * 7))
+            
             return await self.__cache__.aset(name, value)
     
+    @staticmethod
+    def get_validators(headers):
+        '''
+        Get cache validators from response headers.
+        Returns dict or None.
+        '''
+        validators = {}
+        if headers.get('ETag'):
+            validators['etag'] = headers.get('ETag')
+        if headers.get('Last-Modified'):
+            validators['lastModified'] = headers.get('Last-Modified')
+        return validators or None
+    
+    @staticmethod
+    def is_stale(data):
+        '''
+        Check if cached data should be revalidated.
+        '''
+        return (
+            type(data) is dict
+            and '_freshUntil' in data
+            and data['_freshUntil'] < datetime.now().timestamp()
+        )
+    
+    ## Seconds to keep failed fetches by failure class
+    NEGATIVE_CACHE_TTL = {
+        'gone': 86400,
+        'not_found': 3600,
+        'denied': 600,
+        'invalid': 600,
+        'error': 300,
+        'unavailable': 120,
+        'timeout': 60,
+        ## Blocklist may change any time
+        'blocked': 0,
+    }
+    
+    NEGATIVE_CACHE_GENERATION_KEY = 'messy-fediverse:negative-cache-generation'
+    
+    @staticmethod
+    def classify_failure(status, error):
+        '''
+        Get failure class of failed request.
+        status: int HTTP status or None
+        error: exception or response content
+        Returns string.
+        '''
+        if status == 410:
+            return 'gone'
+        if status == 404:
+            return 'not_found'
+        if status in (401, 403):
+            return 'denied'
+        if status == 429 or (status and status >= 500):
+            return 'unavailable'
+        if isinstance(error, HostBlocked):
+            return 'blocked'
+        if isinstance(error, (HostUnavailable, RateLimited)):
+            return 'unavailable'
+        if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+            return 'timeout'
+        if isinstance(error, ResponseTooLarge):
+            return 'invalid'
+        if isinstance(error, BaseException):
+            return 'error'
+        ## Got something which isn't JSON object
+        return 'invalid'
+    
+    @staticmethod
+    def is_negative_cache_entry(data):
+        return type(data) is dict and data.get('_negativeCache') is True
+    
+    async def negative_cache_generation(self):
+        return await self.__cache__.aget(self.NEGATIVE_CACHE_GENERATION_KEY, 0)
+    
+    async def negative_cache_set(self, url, status, error, data):
+        '''
+        Cache failed fetch.
+        url: string
+        status: int HTTP status or None
+        error: exception or response content
+        data: error string returned to caller
+        '''
+        if self.__cache__ is None:
+            return
+        
+        failure = self.classify_failure(status, error)
+        ttl = self.option('NEGATIVE_CACHE_TTL', {}).get(failure, self.NEGATIVE_CACHE_TTL[failure])
+        if not ttl:
+            return
+        
+        if type(data) is not str:
+            data = str(data)
+        if not data.startswith('ERROR:'):
+            data = f'ERROR: {failure}: {data[:128]}'
+        
+        self.__aget_stats__['negative_sets'] += 1
+        self.__aget_stats__[f'negative_{failure}'] = self.__aget_stats__.get(f'negative_{failure}', 0) + 1
+        
+        return await self.__cache__.aset(self.mk_cache_key(url), {
+            '_negativeCache': True,
+            'failure': failure,
+            'status': status,
+            'error': data,
+            'generation': await self.negative_cache_generation(),
+        }, ttl)
+    
+    async def negative_cache_get(self, entry):
+        '''
+        Returns cached error string or None if entry was cleared.
+        '''
+        if entry.get('generation') != await self.negative_cache_generation():
+            return None
+        self.__aget_stats__['negative_hits'] += 1
+        return entry.get('error')
+    
+    def clear_negative_cache(self):
+        '''
+        Invalidate all cached failures.
+        Entries are not deleted but ignored after this.
+        '''
+        if self.__cache__ is None:
+            return
+        generation = self.__cache__.get(self.NEGATIVE_CACHE_GENERATION_KEY, 0)
+        self.__cache__.set(self.NEGATIVE_CACHE_GENERATION_KEY, generation + 1, None)
+    
     @property
     def user(self):
         return self.__user__
     
+    @property
+    def signer(self):
+        return self.__signer__
+    
+    @property
+    def stats(self):
+        '''
+        Runtime stats, for monitoring.
+        '''
+        stats = {
+            'sign': self.__signer__.stats.copy(),
+            'connections': self.__connection_stats__.copy(),
+            'aget': self.__aget_stats__.copy(),
+            'latency': self.__latency__.stats.copy(),
+            'breaker': dict(self.__breaker__.stats, open_hosts=self.__breaker__.open_hosts()),
+        }
+        ## Schedulers are per event loop, summing up
+        scheduler_stats = {'loops': 0}
+        for loop, state in list(self.__loops__.items()):
+            if 'scheduler' in state:
+                scheduler_stats['loops'] += 1
+                for key, value in state['scheduler'].stats.items():
+                    scheduler_stats[key] = scheduler_stats.get(key, 0) + value
+        stats['scheduler'] = scheduler_stats
+        return stats
+    
+    @property
+    def breaker(self):
+        return self.__breaker__
+    
+    def option(self, name, default=None):
+        return self.__options__.get(name, default)
+    
     def normalize_file_path(self, filename):
         '''
         Normalizing file path. Making it absolute and other sanitizings.
@@ -231,80 +604,269 @@ class FediverseActor:
             result = path.os.unlink(filepath)
         return result
     
+    def loop_state(self):
+        '''
+        Returns dict of state bound to current event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        state = self.__loops__.get(loop)
+        if state is None:
+            state = {}
+            self.__loops__[loop] = state
+            ## Started async generator is registered in the loop and
+            ## finalized by loop.shutdown_asyncgens() which asyncio.run()
+            ## (and async_to_sync()) calls before closing the loop.
+            ## There are no awaits before first yield, so it's started
+            ## without awaiting.
+            guard = self._loop_guard(state)
+            try:
+                guard.asend(None).send(None)
+            except StopIteration:
+                pass
+            state['guard'] = guard
+        return state
+    
+    @staticmethod
+    async def _loop_guard(state):
+        '''
+        Closes HTTP session of event loop when the loop is shutting down,
+        so that sessions of short living loops don't leak.
+        '''
+        try:
+            yield
+        finally:
+            session = state.pop('session', None)
+            if session is not None and not session.closed:
+                await session.close()
+    
     @property
     def _session(self):
-        session = None
-        to_discard = set()
-        nowts = datetime.now().timestamp()
-        for s in self.__sessions__:
-            if not hasattr(s, 'ts_created') or nowts - s.ts_created > 120 or s.closed or s._loop.is_closed() or not s._loop.is_running():
-                ## Discard old or closed sessions
-                to_discard.add(s)
-            else:
-                session = s
-        
-        if not session:
-            ## No session to reuse, creating new
-            session = aiohttp.ClientSession()
-            session.ts_created = nowts
-            # session.discarded_sessions = to_discard
-            if not hasattr(session, 'tasks'):
-                session.tasks = set()
-            self.__sessions__.add(session)
-        
-        for s in to_discard:
-            self.__sessions__.discard(s)
-            ## Well, we need to await it somehow, but it's sync function
-            # session.tasks.add(asyncio.create_task(s.close()))
-            session.tasks.add(asyncio.create_task(self.__close_session__(s)))
-        
+        '''
+        HTTP session living as long as current event loop,
+        so that connections are kept alive and reused.
+        '''
+        state = self.loop_state()
+        session = state.get('session')
+        if session is None or session.closed:
+            session = self.new_session()
+            state['session'] = session
         return session
     
-    @staticmethod
-    async def __close_session__(session):
-        close_fail = False
-        try:
+    @property
+    def scheduler(self):
+        '''
+        Requests scheduler of current event loop,
+        limits concurrency and rate of requests per host.
+        '''
+        state = self.loop_state()
+        scheduler = state.get('scheduler')
+        if scheduler is None:
+            scheduler = DeliveryScheduler(
+                concurrency=self.option('DELIVERY_CONCURRENCY', 64),
+                per_host=self.option('DELIVERY_CONCURRENCY_PER_HOST', 4),
+                rate=self.option('DELIVERY_RATE_PER_HOST', 5.0),
+                burst=self.option('DELIVERY_BURST_PER_HOST', 10),
+                max_wait=self.option('DELIVERY_MAX_WAIT', 60.0),
+                maxhosts=self.option('DELIVERY_SCHEDULER_HOSTS', 4096),
+            )
+            state['scheduler'] = scheduler
+        return scheduler
+    
+    def on_response(self, request, response):
+        '''
+        Called when response headers received.
+        request: ActorRequest
+        response: aiohttp response
+        '''
+        if request.started is not None:
+            request.latency = perf_counter() - request.started
+            self.__latency__.add(request.hostname, request.latency)
+        
+        if response.status >= 500:
+            self.__breaker__.failure(request.hostname)
+        else:
+            self.__breaker__.success(request.hostname)
+        
+        if response.status in (429, 503):
+            ## Honouring "Too Many Requests"
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is None and response.status == 429:
+                retry_after = self.option('DELIVERY_DEFAULT_RETRY_AFTER', 60.0)
+            if retry_after:
+                self.scheduler.defer(request.hostname, retry_after)
+    
+    def check_host(self, hostname):
+        '''
+        Raises HostBlocked if domain is blocked.
+        Blocklist is an object with is_blocked(hostname) method
+        set to "blocklist" attribute.
+        '''
+        ## FIXME we should be independent of django models
+        blocklist = getattr(self, 'blocklist', None)
+        if blocklist is not None and blocklist.is_blocked(hostname):
+            raise HostBlocked(f'{hostname} is blocked')
+    
+    def is_blocked_url(self, url):
+        blocklist = getattr(self, 'blocklist', None)
+        return blocklist is not None and blocklist.is_blocked_url(url)
+    
+    def on_request_error(self, request, error, waited):
+        '''
+        Called when request failed without response.
+        request: ActorRequest
+        error: exception
+        waited: float, seconds
+        '''
+        if isinstance(error, asyncio.TimeoutError):
+            ## Slow host gets longer timeout next time
+            self.__latency__.add(request.hostname, waited, timeout=True)
+        if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, OSError)):
+            self.__breaker__.failure(request.hostname)
+    
+    def request_timeout(self, url, method='get'):
+        '''
+        Timeouts for request based on recent latency of the host.
+        Unknown hosts get full timeout.
+        Returns aiohttp.ClientTimeout
+        '''
+        hostname = urlparse(url).hostname
+        if method == 'get':
+            total = self.option('HTTP_TIMEOUT_GET', 30.0)
+        else:
+            total = self.option('HTTP_TIMEOUT', 90.0)
+        connect_ceiling = min(total, self.option('HTTP_CONNECT_TIMEOUT', 10.0))
+        
+        ## Connection is usually established in less than response arrives,
+        ## so the same estimate is safe for both.
+        connect = self.__latency__.timeout(hostname,
+            floor=self.option('HTTP_CONNECT_TIMEOUT_FLOOR', 3.0),
+            ceiling=connect_ceiling, default=connect_ceiling)
+        read = self.__latency__.timeout(hostname,
+            floor=self.option('HTTP_READ_TIMEOUT_FLOOR', 5.0),
+            ceiling=total, default=total)
+        
+        return aiohttp.ClientTimeout(total=total, sock_connect=connect, sock_read=read)
+    
+    def new_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.option('HTTP_POOL_LIMIT', 100),
+            limit_per_host=self.option('HTTP_POOL_LIMIT_PER_HOST', 8),
+            ttl_dns_cache=self.option('HTTP_DNS_CACHE_TTL', 300),
+            keepalive_timeout=self.option('HTTP_KEEPALIVE_TIMEOUT', 60),
+        )
+        self.__connection_stats__['sessions'] += 1
+        return aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[self.get_connection_trace_config()]
+        )
+    
+    def get_connection_trace_config(self):
+        '''
+        Trace config collecting connection reuse stats.
+        '''
+        stats = self.__connection_stats__
+        trace_config = aiohttp.TraceConfig()
+        
+        def counter(name):
+            async def on_event(session, trace_config_ctx, params):
+                stats[name] += 1
+            return on_event
+        
+        trace_config.on_request_start.append(counter('requests'))
+        trace_config.on_connection_create_end.append(counter('connections_created'))
+        trace_config.on_connection_reuseconn.append(counter('connections_reused'))
+        trace_config.on_dns_resolvehost_end.append(counter('dns_resolved'))
+        trace_config.on_dns_cache_hit.append(counter('dns_cache_hits'))
+        return trace_config
+    
+    async def close(self):
+        '''
+        Close HTTP session of current event loop.
+        Should be called on shutdown.
+        '''
+        state = self.loop_state()
+        session = state.pop('session', None)
+        if session is not None and not session.closed:
             await session.close()
-        except BaseException as e:
-            close_fail = True
-        if close_fail:
-            ## Never happened
-            try:
-                loop = asyncio.get_running_loop()
-                session._loop = loop
-                await session.close()
-            except BaseException as e:
-                pass
     
-    async def aget(self, url, session=None, *args, **kwargs):
+    def close_all(self):
+        '''
+        Close sessions of event loops which are not running.
+        Sessions of closed loops can't be closed properly, they are just dropped.
+        '''
+        for loop, state in list(self.__loops__.items()):
+            session = state.pop('session', None)
+            if session is None or session.closed:
+                continue
+            if not loop.is_closed() and not loop.is_running():
+                try:
+                    loop.run_until_complete(session.close())
+                except BaseException as e:
+                    pass
+    
+    async def aget(self, url, session=None, *args, nocache=False, negative_cache=True, **kwargs):
         '''
         Async version of get()
+        nocache: bool, skip reading cache and get fresh data from network.
+        negative_cache: bool, False ignores cached failures and doesn't
+            cache new ones (e.g. for public keys, where one failure
+            would make all requests of actor fail for a while).
         '''
         data = None
+        stale = None
         cache_key = self.mk_cache_key(url)
         if url.startswith('https://www.w3.org'):
             return None
         
-        if self.__cache__ is not None and not self.is_internal_uri(cache_key):
+        if self.__cache__ is not None and not nocache and not self.is_internal_uri(cache_key):
             data = await self.__cache__.aget(cache_key, None)
+            if self.is_negative_cache_entry(data) and not negative_cache:
+                data = None
+            elif self.is_negative_cache_entry(data):
+                data = await self.negative_cache_get(data)
+                if data is not None:
+                    self.stderrlog('GOT FAILURE FROM CACHE:', url)
+                    return data
+            elif self.is_stale(data):
+                ## Will ask remote server if it was modified
+                stale = data
+                data = None
         
         if data is None:
             ## No cached data, getting from network.
             self.stderrlog('NO CACHE FOR', cache_key)
-            data, = await self.gather_http_responses(self.get(url, session, *args, **kwargs))
+            inflight = self.loop_state().setdefault('inflight', {})
+            future = inflight.get(cache_key)
             
-            if type(data) is dict:
-                ## FIXME why is it here?
-                if 'type' in data and data['type'] == 'Person':
-                    person_url = urlparse(data['id'])
-                    if 'preferredUsername' in data:
-                        data['user@host'] = f'{data["preferredUsername"]}@{person_url.hostname}'
-                
-                self.stderrlog('SETTING CACHE:', url)
-                await self.cache_set(url, data)
+            if future is not None:
+                ## Same URL is being fetched already, waiting for it
+                ## instead of making another request.
+                self.__aget_stats__['coalesced'] += 1
+                try:
+                    data = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    if not future.cancelled():
+                        raise
+                    ## Fetching coroutine was cancelled, not us
+                    return await self.aget(url, session, *args, nocache=nocache, negative_cache=negative_cache, **kwargs)
+                ## Callers may modify result, so each one gets own copy
+                data = deepcopy(data)
+            else:
+                future = asyncio.get_running_loop().create_future()
+                inflight[cache_key] = future
+                try:
+                    data = await self._aget_fetch(url, session, *args, stale=stale, negative_cache=negative_cache, **kwargs)
+                    future.set_result(deepcopy(data))
+                finally:
+                    if not future.done():
+                        future.cancel()
+                    inflight.pop(cache_key, None)
         else:
             ## Got data from cache
+            self.__aget_stats__['cache_hits'] += 1
             if type(data) is dict:
+                data.pop('_validators', None)
+                data.pop('_freshUntil', None)
                 ## Mark that we got if from the cache
                 ## to skip caching again
                 data['_cached'] = True
@@ -312,6 +874,117 @@ class FediverseActor:
         
         return data
     
+    async def _aget_fetch(self, url, session=None, *args, stale=None, negative_cache=True, **kwargs):
+        '''
+        Get URL from network and cache result.
+        stale: dict, stale cached data to revalidate (optional)
+        negative_cache: bool, cache failure
+        '''
+        self.__aget_stats__['fetches'] += 1
+        
+        if stale is not None:
+            ## Conditional request
+            validators = stale.get('_validators') or {}
+            headers = dict(kwargs.get('headers') or {})
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('lastModified'):
+                headers['If-Modified-Since'] = validators['lastModified']
+            kwargs['headers'] = headers
+        
+        ts_started = datetime.now().timestamp()
+        result = await self._fetch_request(self.get(url, session, *args, **kwargs))
+        data = error = result['response']
+        if isinstance(data, BaseException):
+            data = self.format_response_error(error, ts_started, datetime.now().timestamp())
+        
+        if stale is not None:
+            validators = stale.pop('_validators', None)
+            stale.pop('_freshUntil', None)
+            stale.pop('_cached', None)
+            
+            if result['status'] == 304:
+                ## Not modified, just refreshing cache TTL
+                self.__aget_stats__['revalidated'] += 1
+                await self.cache_set(url, stale, self.get_validators(result['headers']) or validators)
+                return stale
+            
+            if type(data) is not dict:
+                ## Remote host failed, using stale data for a while
+                self.__aget_stats__['stale_served'] += 1
+                failure = self.classify_failure(result['status'], error)
+                ttl = self.option('NEGATIVE_CACHE_TTL', {}).get(failure, self.NEGATIVE_CACHE_TTL[failure])
+                stale_copy = dict(stale)
+                stale_copy['_validators'] = validators
+                stale_copy['_freshUntil'] = datetime.now().timestamp() + ttl
+                await self.__cache__.aset(self.mk_cache_key(url), stale_copy, self.option('CACHE_REVALIDATE_TTL', 86400 * 7))
+                return stale
+        
+        if type(data) is dict:
+            ## FIXME why is it here?
+            if 'type' in data and data['type'] == 'Person':
+                person_url = urlparse(data['id'])
+                if 'preferredUsername' in data:
+                    data['user@host'] = f'{data["preferredUsername"]}@{person_url.hostname}'
+            
+            self.stderrlog('SETTING CACHE:', url)
+            await self.cache_set(url, data, self.get_validators(result['headers']))
+        elif negative_cache and not self.is_internal_uri(url):
+            ## Caching failure for a while, so that we don't
+            ## ask dead hosts again and again.
+            await self.negative_cache_set(url, result['status'], error, data)
+        
+        return data
+    
+    async def is_deleted(self, url):
+        '''
+        Check if remote object is gone (410 or 404 response).
+        "Gone" is cached like aget() failures, other answers are cached
+        for DELETED_CHECK_TTL seconds. Concurrent checks of same URL
+        make one request.
+        '''
+        cache_key = 'messy-fediverse:not-deleted:' + self.mk_cache_key(url)
+        if self.__cache__ is not None and await self.__cache__.aget(cache_key):
+            return False
+        
+        inflight = self.loop_state().setdefault('inflight_deleted', {})
+        future = inflight.get(cache_key)
+        if future is not None:
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        inflight[cache_key] = future
+        try:
+            result = await self._fetch_request(self.get(url), truncate=True)
+            deleted = result['status'] in (404, 410)
+            if deleted:
+                await self.negative_cache_set(url, result['status'], result['response'], result['response'])
+            elif self.__cache__ is not None:
+                await self.__cache__.aset(cache_key, True, self.option('DELETED_CHECK_TTL', 300))
+            future.set_result(deleted)
+        finally:
+            if not future.done():
+                future.cancel()
+            inflight.pop(cache_key, None)
+        
+        return deleted
+    
+    async def cache_evict(self, urls):
+        '''
+        Remove cached data of given URLs.
+        '''
+        if self.__cache__ is not None and urls:
+            await self.__cache__.adelete_many(list({self.mk_cache_key(url) for url in urls}))
+    
+    async def cache_get(self, url):
+        '''
+        Get cached data of URL without fetching it.
+        Returns None if nothing is cached.
+        '''
+        if self.__cache__ is None:
+            return None
+        return await self.__cache__.aget(self.mk_cache_key(url), None)
+    
     def get(self, url, session=None, *args, **kwargs):
         '''
         Making request to specified URL.
@@ -357,15 +1030,11 @@ class FediverseActor:
             kwargs['data'] = json.dumps(kwargs['json'])
             del(kwargs['json'])
         
-        ## Updates kwargs with http signature
-        self.sign_request(url, method, kwargs)
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = self.request_timeout(url, method)
         
-        timeout = 30.0
-        if method != 'get':
-            timeout = 90.0
-        
-        ## Returns coroutine
-        return getattr(session, method)(url, timeout=timeout, *args, **kwargs)
+        ## Returns awaitable, request is signed when it starts
+        return ActorRequest(self, session, method, url, *args, **kwargs)
     
     @staticmethod
     def is_coroutine(self, something):
@@ -384,36 +1053,86 @@ class FediverseActor:
                 return result
             return coro(result)
     
-    async def _fetch_request(self, context_manager):
+    async def _fetch_request(self, context_manager, truncate=False):
+        '''
+        truncate: bool, body isn't really needed, so too large successful
+            response is truncated instead of failing (see read_response()).
+        '''
         content = None
         url = None
+        status = None
+        headers = {}
         try:
             async with context_manager as response:
                 url = response.url
+                status = response.status
+                headers = response.headers
                 # Always read the body first so it's available for success or error
-                if 'json' in response.headers.get('content-type', ''):
-                    try:
-                        content = await response.json()
-                    except Exception:
-                        content = await response.text()
+                if response.status == 304:
+                    ## Not modified, no body
+                    pass
                 else:
-                    content = await response.text()
-
+                    content = await self.read_response(response, truncate)
+                
                 if not response.ok:
                     # If not 200/OK, create an exception but attach the actual content
                     content = Exception(f'HTTP {response.status}: {response.reason}',
-                        f'URL: {response.url}', content[:128])
-
+                        f'URL: {response.url}', (content or '')[:128])
+        
         except Exception as e:
             # This catches network/timeout errors
             content = e
     
-        return {'url': url, 'response': content}
+        return {'url': url, 'response': content, 'status': status, 'headers': headers}
     
-    async def gather_http_responses(self, *tasks):
+    async def read_response(self, response, truncate=False):
+        '''
+        Read response body not more than allowed size.
+        Error responses bodies are truncated, successful responses
+        bigger than allowed are aborted with ResponseTooLarge exception.
+        response: aiohttp response
+        truncate: bool, truncate successful responses too (e.g. response
+            to delivery, when only status matters).
+        Returns parsed JSON or string.
+        '''
+        is_json = 'json' in response.headers.get('content-type', '')
+        if not response.ok:
+            limit = self.option('MAX_ERROR_BODY_SIZE', 512)
+        elif is_json:
+            limit = self.option('MAX_RESPONSE_SIZE_JSON', 2 * 1024 * 1024)
+        else:
+            limit = self.option('MAX_RESPONSE_SIZE_TEXT', 64 * 1024)
+        
+        if response.ok and not truncate and response.content_length and response.content_length > limit:
+            ## Not reading at all
+            raise ResponseTooLarge(f'Response is too large: {response.content_length} > {limit}', f'URL: {response.url}')
+        
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(16384):
+            body.extend(chunk)
+            if len(body) > limit:
+                if response.ok and not truncate:
+                    raise ResponseTooLarge(f'Response is too large: > {limit}', f'URL: {response.url}')
+                ## Error body is needed only for message,
+                ## or caller doesn't need body at all
+                del(body[limit:])
+                break
+        
+        content = bytes(body).decode(response.charset or 'utf-8', errors='replace')
+        if is_json and response.ok:
+            try:
+                content = json.loads(content)
+            except ValueError:
+                pass
+        return content
+    
+    async def gather_http_responses(self, *tasks, truncate=True):
         '''
         Gathers multiple async requests.
         tasks: list of tasks or coroutines
+        truncate: bool, truncate too large responses instead of failing,
+            used for POSTs (deliveries) where remote host accepted
+            activity whatever it replied with.
         '''
         if not len(tasks):
             return tasks
@@ -421,7 +1140,7 @@ class FediverseActor:
         ts_started = datetime.now().timestamp()
         
         return_exceptions = True ## not self.__DEBUG__
-        tasks = [self._fetch_request(t) for t in tasks]
+        tasks = [self._fetch_request(t, truncate) for t in tasks]
         tasks = await asyncio.gather(*tasks, return_exceptions=return_exceptions)
         ts_ended = datetime.now().timestamp()
         
@@ -430,15 +1149,24 @@ class FediverseActor:
             result = result['response']
             tasks[n] = result
             if isinstance(result, BaseException):
-                ## We return exception as string FIXME for debugging
-                tasks[n] = f'ERROR: {repr(result)}; START: {ts_started}; END: {ts_ended}, TIME: {ts_ended-ts_started}'
-                for a in result.args:
-                    a = str(a)
-                    if a and a not in tasks[n]:
-                        tasks[n] = f'{tasks[n]}; {a}'
+                tasks[n] = self.format_response_error(result, ts_started, ts_ended)
         
         return tasks
     
+    @staticmethod
+    def format_response_error(error, ts_started, ts_ended):
+        '''
+        error: exception
+        Returns error string.
+        '''
+        ## We return exception as string FIXME for debugging
+        result = f'ERROR: {repr(error)}; START: {ts_started}; END: {ts_ended}, TIME: {ts_ended-ts_started}'
+        for a in error.args:
+            a = str(a)
+            if a and a not in result:
+                result = f'{result}; {a}'
+        return result
+    
     async def parse_tags(self, content):
         words = self._rewhitespace.split(content)
         userids = []
@@ -615,116 +1343,139 @@ class FediverseActor:
         '''
         Sends activity to other instances.
         activity: dict, activity data.
+        Returns activity.
         '''
         # if 'object' not in activity or 'tag' not in activity['object']:
         #     return False
         
+        endpoints = await self.federation_endpoints(activity)
+        results = await self.deliver(activity, endpoints)
+        
+        ## For debug
+        if self.__DEBUG__:
+            activity['_endpointsResults'] = {r['endpoint']: r['result'] for r in results}
+        
+        return activity
+    
+    async def federation_endpoints(self, activity):
+        '''
+        Collects inboxes activity should be sent to.
+        Mentioned users are added to "cc" of activity.
+        activity: dict, activity data.
+        Returns list of endpoint URLs.
+        '''
         results = []
-        ## If not empty, we retry failed requests.
-        endpoints = list(activity.get('_failedRequests', {}))
-        
-        if not len(endpoints):
-            ## FIXME we should be independent of django models
-            if hasattr(self, 'federated_endpoints'):
-                async for endpoint in self.federated_endpoints.aiterator():
-                    if endpoint.uri not in endpoints:
-                        endpoints.append(endpoint.uri)
+        endpoints = []
+        
+        ## FIXME we should be independent of django models
+        federated_endpoints = getattr(self, 'federated_endpoints', None)
+        if federated_endpoints is not None:
+            async for endpoint in federated_endpoints.aiterator():
+                ## Endpoints failing for long time are probed only from time to time
+                if endpoint.uri not in endpoints and endpoint.is_available() and not self.is_blocked_url(endpoint.uri):
+                    endpoints.append(endpoint.uri)
+        
+        ## Collecting endpoints of mentioned users
+        act_object = activity.get('object')
+        if type(act_object) is dict:
+            if 'tag' in act_object:
+                for tag in act_object['tag']:
+                    if tag.get('type') == 'Mention' and 'href' in tag and tag['href'] != self.id:
+                        results.append(self.aget(tag['href']))
             
-            ## Collecting endpoints of mentioned users
-            act_object = activity.get('object')
-            if type(act_object) is dict:
-                if 'tag' in act_object:
-                    for tag in act_object['tag']:
-                        if tag.get('type') == 'Mention' and 'href' in tag and tag['href'] != self.id:
-                            results.append(self.aget(tag['href']))
-                
-                for to in (act_object.get('to', []) + act_object.get('cc', [])):
-                    if 'www.w3.org' in to or to in results:
-                        continue
-                    results.append(self.aget(to))
-            
-            for to in (activity.get('to', []) + activity.get('cc', [])):
+            for to in (act_object.get('to', []) + act_object.get('cc', [])):
                 if 'www.w3.org' in to or to in results:
                     continue
                 results.append(self.aget(to))
+        
+        for to in (activity.get('to', []) + activity.get('cc', [])):
+            if 'www.w3.org' in to or to in results:
+                continue
+            results.append(self.aget(to))
+        
+        if len(results) > 0:
+            results = await asyncio.gather(*results, return_exceptions=True)
+        
+        for user in results:
+            endpoint = None
+            if type(user) is dict and 'endpoints' in user and 'sharedInbox' in user['endpoints']:
+                endpoint = user['endpoints']['sharedInbox']
+            elif type(user) is dict and 'inbox' in user:
+                ## I saw instances without sharedInbox, at least Honk
+                endpoint = user['inbox']
             
-            if len(results) > 0:
-                results = await asyncio.gather(*results, return_exceptions=True)
+            if type(endpoint) is list and len(endpoint) > 0:
+                ## Never saw such case but anyway...
+                endpoint = endpoint[0]
             
-            for user in results:
-                endpoint = None
-                if type(user) is dict and 'endpoints' in user and 'sharedInbox' in user['endpoints']:
-                    endpoint = user['endpoints']['sharedInbox']
-                elif 'inbox' in user:
-                    ## I saw instances without sharedInbox, at least Honk
-                    endpoint = user['inbox']
-                
-                if type(endpoint) is list and len(endpoint) > 0:
-                    ## Never saw such case but anyway...
-                    endpoint = endpoint[0]
+            if endpoint:
+                if endpoint not in endpoints and not self.is_blocked_url(endpoint):
+                    endpoints.append(endpoint)
                 
-                if endpoint:
-                    if endpoint not in endpoints:
-                        endpoints.append(endpoint)
-                    
-                    if (
-                        type(act_object) is dict
-                        and user['id'] not in act_object['cc']
-                        and user['id'] not in act_object['to']
-                    ):
-                        act_object['cc'].append(user['id'])
-                    if (
-                        user['id'] not in activity['cc']
-                        and user['id'] not in activity['to']
-                    ):
-                        activity['cc'].append(user['id'])
-            ## if len(endpoints)
-        
-        results = []
-        
-        # loop = asyncio.get_running_loop()
-        # start_ts = loop.time()
-        
-        ## Temporarily removing private properties
-        ## before sending.
-        activity_priv_props = {}
-        for prop in list(activity.keys()):
-            if prop.startswith('_'):
-                activity_priv_props[prop] = activity[prop]
-                del(activity[prop])
-        
-        for endpoint in endpoints:
-            results.append(self.post(endpoint, json=activity))
-        
-        results = await self.gather_http_responses(*results)
-        
-        ## Restoring private props
-        activity.update(activity_priv_props)
-        
-        attempt_n = activity.get('_requestAttempt', 0)
-        if attempt_n:
-            ## Saving previous requests info
-            activity[f'_endpointsResults.{attempt_n}'] = activity.get('_endpointsResults', {})
-            activity[f'_failedRequests.{attempt_n}'] = activity.get('_failedRequests', {})
-        activity['_endpointsResults'] = {}
-        activity['_failedRequests'] = {}
-        
-        for n, result in enumerate(results):
-            if self.__DEBUG__:
-                activity['_endpointsResults'][endpoints[n]] = result
-            if self.is_response_error(result):
-                activity['_failedRequests'][endpoints[n]] = result
+                if (
+                    type(act_object) is dict
+                    and user['id'] not in act_object['cc']
+                    and user['id'] not in act_object['to']
+                ):
+                    act_object['cc'].append(user['id'])
+                if (
+                    user['id'] not in activity['cc']
+                    and user['id'] not in activity['to']
+                ):
+                    activity['cc'].append(user['id'])
+        
+        return endpoints
+    
+    async def deliver(self, activity, endpoints):
+        '''
+        Posts activity to endpoints.
+        activity: dict, activity data.
+        endpoints: list of endpoint URLs
+        Returns list of dicts {'endpoint', 'result', 'error', 'attempted', 'blocked', 'latency'},
+        "error" is error string or None, "attempted" is False if request wasn't made
+        (host is failing, blocked or asked to wait).
+        '''
+        ## Body is encoded and digested once for all endpoints,
+        ## only signature is made per request.
+        body, digest = self.mk_payload(activity)
         
-        ## For debug
-        if self.__DEBUG__:
-            if attempt_n:
-                activity[f'_requestEndpoints.{attempt_n}'] = activity.get('_requestEndpoints', {})
-            activity['_requestEndpoints'] = endpoints
+        requests = [self.post(endpoint, data=body, headers={'Digest': digest}) for endpoint in endpoints]
+        for request in requests:
+            request.wait_rate_limits = True
+        responses = await self.gather_http_responses(*requests)
         
-        attempt_n += 1
-        activity['_requestAttempt'] = attempt_n
+        results = []
+        for n, response in enumerate(responses):
+            results.append({
+                'endpoint': endpoints[n],
+                'result': response,
+                'error': response if self.is_response_error(response) else None,
+                'attempted': not isinstance(requests[n].error, (HostUnavailable, HostBlocked, RateLimited)),
+                'blocked': isinstance(requests[n].error, HostBlocked),
+                'latency': requests[n].latency,
+            })
         
-        return activity
+        await self.update_endpoints_health(results)
+        return results
+    
+    async def update_endpoints_health(self, results):
+        '''
+        Saves delivery results to federated endpoints health stats.
+        results: list of dicts returned by deliver()
+        '''
+        ## FIXME we should be independent of django models
+        federated_endpoints = getattr(self, 'federated_endpoints', None)
+        if federated_endpoints is None:
+            return
+        
+        health = {}
+        for result in results:
+            ## Request wasn't made, nothing to say about endpoint
+            if result['attempted']:
+                health[result['endpoint']] = (result['error'], result['latency'])
+        
+        if health:
+            await federated_endpoints.model.aupdate_health(health)
     
     async def resend_failed_activity(self, activity):
         '''
@@ -733,8 +1484,11 @@ class FediverseActor:
         old_results = activity.get('failedRequests', {})
         urls = tuple(old_results.keys())
         results = []
+        body, digest = self.mk_payload(activity)
         for url in urls:
-            results.append(self.post(url, json=activity))
+            request = self.post(url, data=body, headers={'Digest': digest})
+            request.wait_rate_limits = True
+            results.append(request)
         results = await self.gather_http_responses(*results)
         failed_requests = {}
         for n, result in enumerate(results):
@@ -918,6 +1672,27 @@ class FediverseActor:
         
         return activity
     
+    @staticmethod
+    def mk_digest(body):
+        '''
+        Make Digest header value.
+        body: string or bytes
+        '''
+        if hasattr(body, 'encode'):
+            body = body.encode('utf-8')
+        return 'SHA-256=' + b64encode(sha256(body or b'').digest()).decode('utf-8')
+    
+    @classmethod
+    def mk_payload(cls, activity):
+        '''
+        Encode activity for sending, private properties are skipped.
+        activity: dict
+        Returns tuple (body bytes, Digest header value).
+        '''
+        payload = {k: v for k, v in activity.items() if not k.startswith('_')}
+        body = json.dumps(payload).encode('utf-8')
+        return body, cls.mk_digest(body)
+    
     def sign_request(self, url, method='post', request={}):
         '''
         Make HTTP signature.
@@ -925,6 +1700,25 @@ class FediverseActor:
         request: dict, at least should contain 'headers'.
         Returns headers dict (also modifies request dict in place).
         '''
+        str2sign, headers_to_sign = self.prepare_signature(url, method, request)
+        sign = self.__signer__.sign(str2sign).decode('utf-8')
+        return self.apply_signature(request, headers_to_sign, sign)
+    
+    async def asign_request(self, url, method='post', request={}):
+        '''
+        Async version of sign_request(), signature is made in a thread pool.
+        '''
+        str2sign, headers_to_sign = self.prepare_signature(url, method, request)
+        sign = (await self.__signer__.asign(str2sign)).decode('utf-8')
+        return self.apply_signature(request, headers_to_sign, sign)
+    
+    def prepare_signature(self, url, method='post', request={}):
+        '''
+        Prepare request headers for HTTP signature.
+        url: string URL
+        request: dict, request kwargs, headers are updated in place.
+        Returns tuple (string to sign, signed headers names).
+        '''
         
         request_date = datetime.now()
         
@@ -948,36 +1742,59 @@ class FediverseActor:
         headers_to_sign = '(request-target) host date'
         
         if 'data' in request:
-            request['headers']['Digest'] = 'SHA-256=' + b64encode(sha256((request['data'] or '').encode('utf-8')).digest()).decode('utf-8')
+            if 'Digest' not in request['headers']:
+                request['headers']['Digest'] = self.mk_digest(request['data'])
             headers.append(f'digest: {request["headers"]["Digest"]}')
             headers_to_sign = f'{headers_to_sign} digest'
         
         str2sign = '\n'.join(headers)
         
+        return str2sign, headers_to_sign
+    
+    def apply_signature(self, request, headers_to_sign, sign):
+        '''
+        Set Signature header.
+        request: dict, request kwargs
+        headers_to_sign: string, signed headers names
+        sign: string, base64 encoded signature
+        Returns headers dict.
+        '''
         ## deprecated method
         # pkey = crypto.load_privatekey(crypto.FILETYPE_PEM, self.__privkey__)
         # sign = b64encode(crypto.sign(pkey, str2sign, 'sha256')).decode('utf-8')
-        ## Using this instead of deprecated method
-        sign = self.crypt_sign(str2sign, self.__privkey__).decode('utf-8')
-        
+        ## Using SignEngine instead of deprecated method
         request['headers']['Signature'] = f'keyId="{self.__user__["publicKey"]["id"]}",algorithm="rsa-sha256",headers="{headers_to_sign}",signature="{sign}"'
         return request['headers']
 
     @staticmethod
-    def crypt_sign(payload, pkey):
-        if hasattr(payload, 'encode'):
-            ## to bytes
-            payload = payload.encode('utf-8')
-        
+    def crypt_load_private_key(pkey):
+        '''
+        Parse PEM private key.
+        pkey: string or bytes
+        Returns private key object.
+        '''
         if hasattr(pkey, 'encode'):
             ## to bytes
             pkey = pkey.encode('utf-8')
         
-        pkey = crypt_serialization.load_pem_private_key(
+        return crypt_serialization.load_pem_private_key(
             pkey,
             password = None,
             backend = crypt_backend(),
         )
+    
+    @staticmethod
+    def crypt_sign(payload, pkey):
+        '''
+        payload: string or bytes
+        pkey: PEM private key or already loaded key object
+        '''
+        if hasattr(payload, 'encode'):
+            ## to bytes
+            payload = payload.encode('utf-8')
+        
+        if not hasattr(pkey, 'sign'):
+            pkey = FediverseActor.crypt_load_private_key(pkey)
         
         return b64encode(
             pkey.sign(
@@ -999,14 +1816,29 @@ class FediverseActor:
         # )
     
     @staticmethod
-    def crypt_verify(payload, signature, pkey):
-        signature = b64decode(signature)
+    def crypt_load_public_key(pkey):
+        '''
+        Parse PEM public key.
+        pkey: string or bytes
+        Returns public key object.
+        '''
         if hasattr(pkey, 'encode'):
             pkey = pkey.encode('utf-8')
+        return crypt_load_pem_public_key(pkey, crypt_backend())
+    
+    @staticmethod
+    def crypt_verify(payload, signature, pkey):
+        '''
+        payload: string or bytes
+        signature: base64 encoded signature
+        pkey: PEM public key or already loaded key object
+        '''
+        signature = b64decode(signature)
         if hasattr(payload, 'encode'):
             payload = payload.encode('utf-8')
         
-        pkey = crypt_load_pem_public_key(pkey, crypt_backend())
+        if not hasattr(pkey, 'verify'):
+            pkey = FediverseActor.crypt_load_public_key(pkey)
         
         return pkey.verify(
             signature,
@@ -1220,3 +2052,5 @@ class FediverseActor:
         '''
         filename = path.join('following', sha256(user_id.encode('utf-8')).hexdigest() + '.json')
         return self.read(filename)
+
+atexit.register(FediverseActor.close_instances)
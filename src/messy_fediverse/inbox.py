@@ -0,0 +1,527 @@
+'''
+Cheap checks done by inbox before any real work.
+'''
+import re
+import json
+from math import ceil
+from time import monotonic, time
+from hashlib import sha1
+from urllib.parse import urlparse
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from .models import Activity, Follower
+from .transport import DomainTrie
+from .blocklist import domain_blocklist
+from .log import log_failure
+
+## Headers stored with incoming activities by default
+STORE_HEADERS = (
+    'Signature',
+    'Digest',
+    'Date',
+    'Host',
+    'User-Agent',
+)
+
+def request_meta(request, names=None):
+    '''
+    Get request headers to store with incoming activity.
+    request: django HttpRequest instance
+    names: list of header names like 'User-Agent' or 'HTTP_USER_AGENT',
+        '*' means all headers.
+    Returns dict with META keys (HTTP_USER_AGENT).
+    '''
+    if names is None:
+        names = settings.MESSY_FEDIVERSE.get('INBOX_STORE_HEADERS', STORE_HEADERS)
+    
+    if names == '*' or '*' in names:
+        return {k: v for k, v in request.META.items() if k.startswith('HTTP_')}
+    
+    meta = {}
+    for name in names:
+        key = name.upper().replace('-', '_')
+        if not key.startswith('HTTP_'):
+            key = 'HTTP_' + key
+        if key in request.META:
+            meta[key] = request.META[key]
+    return meta
+
+class RecentActivities:
+    '''
+    Remembers IDs of recently received activities, so that copies
+    delivered again (shared and direct inbox, relays) are dropped.
+    Recent IDs are kept in memory (LRU) and in Django cache
+    which is shared between processes.
+    '''
+    def __init__(self, maxsize=10000, ttl=3600, cache=None):
+        '''
+        maxsize: int, max number of IDs kept in memory
+        ttl: int, seconds to remember ID
+        cache: optional Django cache object
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__cache__ = cache
+        ## activity id: expiration time
+        self.__ids__ = OrderedDict()
+        self.stats = {
+            'duplicates': 0,
+            'duplicates_cached': 0,
+            'new': 0,
+        }
+    
+    def mk_cache_key(self, activity_id):
+        return 'messy-fediverse-inbox-' + sha1(activity_id.encode()).hexdigest()
+    
+    async def seen(self, activity_id, record=True):
+        '''
+        Checks if activity was received recently and remembers it.
+        activity_id: string
+        record: bool, remember activity, False just checks it
+            (ID may be forged, see own_activity_id()).
+        Returns True if activity is a duplicate.
+        '''
+        now = monotonic()
+        expires = self.__ids__.get(activity_id)
+        if expires is not None:
+            if expires > now:
+                self.stats['duplicates'] += 1
+                return True
+            del(self.__ids__[activity_id])
+        
+        if not record:
+            if self.__cache__ is not None:
+                try:
+                    cached = await self.__cache__.aget(self.mk_cache_key(activity_id))
+                except Exception as e:
+                    log_failure('Inbox cache', e)
+                    cached = None
+                if cached is not None:
+                    self.stats['duplicates'] += 1
+                    self.stats['duplicates_cached'] += 1
+                    return True
+            return False
+        
+        self.__ids__[activity_id] = now + self.ttl
+        if len(self.__ids__) > self.maxsize:
+            self.__ids__.popitem(last=False)
+        
+        if self.__cache__ is not None:
+            try:
+                ## Atomic, so only one of concurrent copies is processed
+                added = await self.__cache__.aadd(self.mk_cache_key(activity_id), 1, self.ttl)
+            except Exception as e:
+                log_failure('Inbox cache', e)
+                added = True
+            if not added:
+                self.stats['duplicates'] += 1
+                self.stats['duplicates_cached'] += 1
+                return True
+        
+        self.stats['new'] += 1
+        return False
+    
+    async def forget(self, activity_id):
+        '''
+        Forget activity, e.g. if it failed to process
+        and remote server should be able to deliver it again.
+        '''
+        self.__ids__.pop(activity_id, None)
+        if self.__cache__ is not None:
+            try:
+                await self.__cache__.adelete(self.mk_cache_key(activity_id))
+            except Exception as e:
+                log_failure('Inbox cache', e)
+
+__recent__ = None
+
+def recent_activities():
+    '''
+    Get RecentActivities configured by MESSY_FEDIVERSE settings
+    INBOX_DEDUP_SIZE and INBOX_DEDUP_TTL, TTL 0 disables it.
+    Returns None if disabled.
+    '''
+    global __recent__
+    ttl = settings.MESSY_FEDIVERSE.get('INBOX_DEDUP_TTL', 3600)
+    if not ttl:
+        return None
+    if __recent__ is None:
+        __recent__ = RecentActivities(
+            maxsize=settings.MESSY_FEDIVERSE.get('INBOX_DEDUP_SIZE', 10000),
+            ttl=ttl,
+            cache=cache
+        )
+    return __recent__
+
+def request_json(request):
+    '''
+    Get parsed JSON body of request, parsed once.
+    Returns dict or None.
+    '''
+    if not hasattr(request, '_inbox_json'):
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            data = None
+        request._inbox_json = data if type(data) is dict else None
+    return request._inbox_json
+
+def actor_id(activity):
+    actor = activity.get('actor')
+    if type(actor) is dict:
+        actor = actor.get('id')
+    return actor if type(actor) is str else None
+
+def own_activity_id(request, activity):
+    '''
+    Get activity ID if it belongs to the host of actor and signature key,
+    others may be forged to make us drop real activity as duplicate.
+    Returns ID or None.
+    '''
+    activity_id = activity.get('id')
+    host = url_host(activity_id)
+    if not host or host != url_host(actor_id(activity)):
+        return None
+    
+    signature = request.headers.get('signature')
+    if signature:
+        key_id = re.search(r'keyId="?([^",]*)', signature)
+        if not key_id or url_host(key_id.group(1)) != host:
+            return None
+    
+    return activity_id
+
+def self_delete_actor(activity):
+    '''
+    Checks if activity is actor deleting own account.
+    Returns actor URI or None.
+    '''
+    if activity.get('type') != 'Delete':
+        return None
+    actor = actor_id(activity)
+    ap_object = activity.get('object')
+    if type(ap_object) is dict:
+        ap_object = ap_object.get('id')
+    if actor and ap_object == actor:
+        return actor
+    return None
+
+def is_relay(actor):
+    '''
+    Guess if actor is a relay by its URI.
+    actor: string
+    '''
+    return type(actor) is str and 'relay' in actor
+
+def url_host(url):
+    if type(url) is not str:
+        return ''
+    try:
+        return (urlparse(url).hostname or '').lower()
+    except ValueError:
+        return ''
+
+class InboxFilter:
+    '''
+    Cheap checks of incoming requests before signature verification.
+    Every rule is a dict:
+        'name': string, used in stats
+        'action': 'drop' (rejected with 403) or 'ack' (accepted with 202, but ignored)
+        'type': list of activity types
+        'object_type': list of object types
+        'actor_host': list of domains, subdomains match too
+        'relay': bool, actor is (not) a relay
+    All given conditions should match. First matched rule is applied.
+    Requests from blocked domains (actor or signature key) are dropped.
+    '''
+    ACTIONS = ('drop', 'ack')
+    
+    def __init__(self, rules=(), blocklist=None, cache=None, flush_interval=60):
+        '''
+        rules: list of dicts
+        blocklist: object with is_blocked(hostname) method (blocklist.DomainBlocklist)
+        cache: optional Django cache object, stats are summed there
+        flush_interval: int, seconds between saving stats to cache
+        '''
+        self.rules = []
+        for n, rule in enumerate(rules):
+            rule = dict(rule)
+            rule.setdefault('name', f'rule{n}')
+            if rule.get('action', 'drop') not in self.ACTIONS:
+                raise ValueError(f'Bad inbox filter action: {rule["action"]}')
+            for k in ('type', 'object_type'):
+                if k in rule:
+                    rule[k] = set(rule[k])
+            if 'actor_host' in rule:
+                rule['actor_host'] = DomainTrie(rule['actor_host'])
+            self.rules.append(rule)
+        self.blocklist = blocklist
+        self.__cache__ = cache
+        self.flush_interval = flush_interval
+        self._flushed_at = monotonic()
+        self.stats = {
+            'passed': 0,
+            'blocked': 0,
+        }
+        self.stats.update((rule['name'], 0) for rule in self.rules)
+        self._saved = dict.fromkeys(self.stats, 0)
+    
+    def check(self, request, key_id=None):
+        '''
+        Check request.
+        request: django HttpRequest instance
+        key_id: string, signature keyId
+        Returns (rule name, action) if request matched or None.
+        '''
+        result = self.match(request, key_id)
+        if result is None:
+            self.stats['passed'] += 1
+        else:
+            self.stats[result[0]] += 1
+        return result
+    
+    def match(self, request, key_id=None):
+        if self.blocklist is not None and key_id and self.blocklist.is_blocked(url_host(key_id)):
+            return ('blocked', 'drop')
+        
+        if self.blocklist is None and not self.rules:
+            return None
+        
+        data = request_json(request)
+        if data is None:
+            return None
+        
+        actor = actor_id(data)
+        actor_host = url_host(actor)
+        
+        if self.blocklist is not None and actor_host and self.blocklist.is_blocked(actor_host):
+            return ('blocked', 'drop')
+        
+        ap_object = data.get('object')
+        object_type = ap_object.get('type') if type(ap_object) is dict else None
+        
+        for rule in self.rules:
+            if 'type' in rule and data.get('type') not in rule['type']:
+                continue
+            if 'object_type' in rule and object_type not in rule['object_type']:
+                continue
+            if 'actor_host' in rule and not rule['actor_host'].match(actor_host):
+                continue
+            if 'relay' in rule and is_relay(actor) != bool(rule['relay']):
+                continue
+            return (rule['name'], rule.get('action', 'drop'))
+        
+        return None
+    
+    def count(self, name):
+        '''
+        Count other shed requests in filter stats.
+        '''
+        if name not in self.stats:
+            self.stats[name] = 0
+            self._saved[name] = 0
+        self.stats[name] += 1
+    
+    def mk_cache_key(self, name):
+        return 'messy-fediverse-inbox-filter-' + sha1(name.encode()).hexdigest()
+    
+    async def flush_stats(self, force=False):
+        '''
+        Adds stats collected since last call to cache,
+        so that they are summed for all processes.
+        '''
+        if self.__cache__ is None or (not force and monotonic() - self._flushed_at < self.flush_interval):
+            return
+        self._flushed_at = monotonic()
+        for name, value in self.stats.items():
+            delta = value - self._saved[name]
+            if not delta:
+                continue
+            key = self.mk_cache_key(name)
+            try:
+                ## Cache may not have the key yet
+                if not await self.__cache__.aadd(key, delta, None):
+                    ## Django's async aincr() is get + set, not atomic
+                    await sync_to_async(self.__cache__.incr)(key, delta)
+            except ValueError:
+                ## Key expired between add and incr
+                continue
+            except Exception as e:
+                log_failure('Inbox cache', e)
+                return
+            self._saved[name] = value
+    
+    def cached_stats(self):
+        '''
+        Returns stats summed for all processes.
+        '''
+        if self.__cache__ is None:
+            return self.stats.copy()
+        keys = {self.mk_cache_key(name): name for name in self.stats}
+        values = self.__cache__.get_many(list(keys))
+        return {name: values.get(key, 0) for key, name in keys.items()}
+
+class KnownActors:
+    '''
+    Checks if we have records of remote actor: follower
+    or author of received activities.
+    Negative answers are cached for ttl seconds.
+    '''
+    def __init__(self, ttl=300, cache=None):
+        self.ttl = ttl
+        self.__cache__ = cache
+    
+    def mk_cache_key(self, actor):
+        return 'messy-fediverse-unknown-actor-' + sha1(actor.encode()).hexdigest()
+    
+    async def contains(self, actor):
+        if self.__cache__ is not None:
+            try:
+                if await self.__cache__.aget(self.mk_cache_key(actor)):
+                    return False
+            except Exception as e:
+                log_failure('Inbox cache', e)
+        
+        known = (
+            await Follower.objects.filter(uri=actor).aexists()
+            or await Activity.objects.filter(actor_uri=actor).aexists()
+        )
+        if not known:
+            await self.set_unknown(actor, True)
+        return known
+    
+    async def set_unknown(self, actor, unknown):
+        if self.__cache__ is None or not actor:
+            return
+        try:
+            if unknown:
+                await self.__cache__.aset(self.mk_cache_key(actor), 1, self.ttl)
+            else:
+                await self.__cache__.adelete(self.mk_cache_key(actor))
+        except Exception as e:
+            log_failure('Inbox cache', e)
+    
+    async def add(self, actor):
+        '''
+        Actor became known (e.g. sent us activity).
+        '''
+        await self.set_unknown(actor, False)
+    
+    async def discard(self, actor):
+        '''
+        Actor was deleted.
+        '''
+        await self.set_unknown(actor, True)
+
+__known_actors__ = None
+
+def known_actors():
+    global __known_actors__
+    if __known_actors__ is None:
+        __known_actors__ = KnownActors(settings.MESSY_FEDIVERSE.get('KNOWN_ACTORS_TTL', 300), cache)
+    return __known_actors__
+
+## Actor fields with URLs which may be cached
+ACTOR_URL_FIELDS = ('outbox', 'inbox', 'followers', 'following', 'featured', 'featuredTags')
+
+async def forget_actor(fediverse, actor, cached=None):
+    '''
+    Removes cached data and follower rows of deleted actor.
+    fediverse: FediverseActor instance
+    actor: string, actor URI
+    cached: dict, cached actor data (optional)
+    '''
+    urls = []
+    if type(cached) is dict and not fediverse.is_negative_cache_entry(cached):
+        urls = [cached[k] for k in ACTOR_URL_FIELDS if type(cached.get(k)) is str]
+    await fediverse.cache_evict(urls)
+    await Follower.objects.filter(uri=actor).adelete()
+    await known_actors().discard(actor)
+
+class InboxRateLimiter:
+    '''
+    Requests counter per remote host, shared by all processes through Django cache.
+    Host may make "burst" requests per window of burst / rate seconds.
+    Counter is created with cache.add() and incremented with cache.incr(),
+    which are atomic, so limit holds with any number of workers.
+    (Django's async aincr() is get + set, so sync incr() is used.)
+    '''
+    def __init__(self, rate=10.0, burst=200, cache=None, maxhosts=1024):
+        '''
+        rate: float, requests per second from one host
+        burst: int, requests from one host allowed at once before rate applies
+        cache: Django cache object
+        maxhosts: int, max number of throttled hosts to count separately
+        '''
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.maxhosts = maxhosts
+        self.__cache__ = cache
+        self.stats = {
+            'allowed': 0,
+            'throttled': 0,
+        }
+        ## hostname: throttled requests count
+        self.throttled_hosts = OrderedDict()
+    
+    @property
+    def window(self):
+        '''
+        Counting window length, seconds.
+        '''
+        return self.burst / self.rate
+    
+    def mk_cache_key(self, host, window_id):
+        return f'messy-fediverse-inbox-rate-{sha1(host.encode()).hexdigest()}-{window_id}'
+    
+    async def take(self, host):
+        '''
+        Count one request of host.
+        Returns 0 if request is allowed, or seconds to wait.
+        '''
+        if not host or not self.rate or self.__cache__ is None:
+            return 0
+        
+        window = self.window
+        now = time()
+        window_id = int(now // window)
+        key = self.mk_cache_key(host, window_id)
+        try:
+            await self.__cache__.aadd(key, 0, ceil(window) + 1)
+            count = await sync_to_async(self.__cache__.incr)(key)
+        except ValueError:
+            ## Expired right after adding, window is over anyway
+            count = 1
+        except Exception as e:
+            log_failure('Inbox cache', e)
+            return 0
+        
+        if count > self.burst:
+            self.stats['throttled'] += 1
+            self.throttled_hosts[host] = self.throttled_hosts.pop(host, 0) + 1
+            if len(self.throttled_hosts) > self.maxhosts:
+                self.throttled_hosts.popitem(last=False)
+            ## Until the next window
+            return (window_id + 1) * window - now
+        
+        self.stats['allowed'] += 1
+        return 0
+
+__filter__ = None
+
+def inbox_filter():
+    '''
+    Get InboxFilter configured by MESSY_FEDIVERSE['INBOX_FILTER_RULES'],
+    requests from blocked domains are dropped too.
+    '''
+    global __filter__
+    if __filter__ is None:
+        __filter__ = InboxFilter(
+            rules=settings.MESSY_FEDIVERSE.get('INBOX_FILTER_RULES', ()),
+            blocklist=domain_blocklist(),
+            cache=cache,
+            flush_interval=settings.MESSY_FEDIVERSE.get('INBOX_FILTER_STATS_INTERVAL', 60)
+        )
+    return __filter__
@@ -0,0 +1,22 @@
+'''
+Logging to stderr.
+'''
+import sys
+from django.conf import settings
+
+def stderrlog(*msg):
+    if (
+        settings.MESSY_FEDIVERSE.get('DEBUG', False)
+        or settings.DEBUG
+        or 'error' in msg or 'ERROR' in msg
+        or 'warning' in msg or 'WARNING' in msg
+    ):
+        print(*msg, file=sys.stderr, flush=True)
+
+def log_failure(what, error):
+    '''
+    Log failure we can go on without (cache, notifications e.t.c.)
+    what: string, what failed
+    error: exception
+    '''
+    stderrlog('WARNING', f'{what} failed: {error!r}')
@@ -52,8 +52,7 @@ class Command(BaseCommand):
             with open(options['json'], 'rb') as f:
                 activity_dict = json.load(f)
                 activity = actor.activity(activity)
-                activity = asyncio.run(actor.prepare_activity(activity))
-                result = asyncio.run(actor.federate(activity))
+                result = asyncio.run(self.afederate(actor, activity))
         
         if options['output_json']:
             with open(options['output_json'], 'wb') as f:
@@ -62,3 +61,10 @@ class Command(BaseCommand):
         self.stdout.write(
             self.style.SUCCESS(f"Federated: {result}")
         )
+    
+    async def afederate(self, actor, activity):
+        try:
+            activity = await actor.prepare_activity(activity)
+            return await actor.federate(activity)
+        finally:
+            await actor.close()
@@ -1,14 +1,22 @@
 from django.core.management.base import BaseCommand, CommandError
-from django.db import close_old_connections
-from messy_fediverse.controller import Replies, save_activity, fediverse_factory
-from messy_fediverse.models import Activity
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q, Count, Min
+from django.utils import timezone
+from messy_fediverse.controller import Replies, save_activity, fediverse_factory, process_incoming
+from messy_fediverse.models import Activity, Delivery, Worker, IncomingActivity, RequestHeaders
+from messy_fediverse.notify import get_notifier
+from messy_fediverse.inbox import inbox_filter
+from messy_fediverse.blocklist import domain_blocklist
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.test import RequestFactory
 import asyncio
 from asgiref.sync import sync_to_async
-from time import sleep
-from datetime import datetime
+from time import sleep, monotonic
+from datetime import timedelta
+from uuid import uuid4
+import socket
+import signal
 import os
 # import tracemalloc
 
@@ -18,6 +26,13 @@ class Command(BaseCommand):
     _request = None
     _actor = None
     _pid = 0
+    _worker_id = ''
+    _lease = 600
+    _claimed_at = 0
+    _notifier = None
+    _stats = None
+    _recheck = False
+    _stopping_at = 0
     _limit = 100
     
     def add_arguments(self, parser):
@@ -40,15 +55,34 @@ class Command(BaseCommand):
             help='Wait seconds between requests'
         )
         
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='Number of activities processed at once'
+        )
+        
         parser.add_argument(
             '--debug',
             action='store_true',
             help='Run in debug mode (more verbose messages)'
         )
         
+        parser.add_argument(
+            '--status',
+            action='store_true',
+            help='Show workers and queue status and exit'
+        )
+    
     
     def handle(self, *args, **options):
+        if options['status']:
+            return self.show_status()
+        
         self._pid = os.getpid()
+        ## Unique across hosts and restarts
+        self._worker_id = f'{socket.gethostname()[:40]}:{self._pid}:{uuid4().hex[:8]}'
+        self._lease = settings.MESSY_FEDIVERSE.get('WORKER_LEASE_TIME', self._lease)
         url = None
         site = None
         ## For debugging forgotten to await.
@@ -72,8 +106,176 @@ class Command(BaseCommand):
         ## FIXME for multiuser instance actor should
         ## be different.
         self._actor = fediverse_factory(self._request)
+        ## Worker may wait for hosts which asked to retry later
+        self._actor.wait_rate_limits = True
+        
+        return asyncio.run(self.ahandle_and_close(**options))
+    
+    async def ahandle_and_close(self, *args, **options):
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop, main_task)
+        
+        await self.register()
+        heartbeat = asyncio.create_task(self.heartbeat())
+        self._notifier = get_notifier()
+        await self._notifier.start()
+        try:
+            return await self.ahandle(*args, **options)
+        finally:
+            heartbeat.cancel()
+            try:
+                await heartbeat
+            except asyncio.CancelledError:
+                pass
+            await self._notifier.stop()
+            await self.unregister()
+            ## Closing keep-alive connections
+            await self._actor.close()
+    
+    def stop(self, main_task):
+        '''
+        Finish current batch and exit, second signal exits immediately.
+        '''
+        if self._done:
+            ## Same signal may be delivered to process and its group at once
+            if monotonic() - self._stopping_at > 1:
+                main_task.cancel()
+            return
+        self.stderr.write(self.style.WARNING('Stopping...'))
+        self._done = True
+        self._stopping_at = monotonic()
+        if self._notifier is not None:
+            self._notifier.wakeup()
+    
+    async def register(self):
+        '''
+        Adds this worker to registry.
+        '''
+        self._stats = {
+            'activities': 0,
+            'deliveries': 0,
+            'lag_total': 0.0,
+            'lag_count': 0,
+        }
+        ## Workers of older versions didn't register, so if there are no
+        ## workers registered, this is the first start after upgrade.
+        upgraded = not await Worker.objects.aexists()
+        await Worker.objects.acreate(worker_id=self._worker_id, hostname=socket.gethostname(), pid=self._pid)
+        
+        if upgraded:
+            ## Older versions claimed activities with worker PID and marked
+            ## them done with -PID, these workers are gone.
+            await Activity.objects.filter(processing_status__lt=0).aupdate(processing_status=20)
+            await Activity.objects.filter(processing_status__gt=0).exclude(processing_status__in=(10, 20, 30)).aupdate(processing_status=0)
+    
+    async def unregister(self):
+        '''
+        Marks worker stopped and returns its unfinished jobs to queue.
+        '''
+        await self.save_heartbeat(stopped_at=timezone.now())
+        await sync_to_async(Worker.release_claims)([self._worker_id])
+    
+    async def save_heartbeat(self, **values):
+        lag = None
+        if self._stats['lag_count']:
+            lag = self._stats['lag_total'] / self._stats['lag_count']
+            self._stats['lag_total'] = 0.0
+            self._stats['lag_count'] = 0
+        await Worker.objects.filter(worker_id=self._worker_id).aupdate(
+            heartbeat_at=timezone.now(),
+            activities_done=self._stats['activities'],
+            deliveries_done=self._stats['deliveries'],
+            delivery_lag=lag,
+            **values
+        )
+    
+    async def heartbeat(self):
+        '''
+        Updates worker registry and releases jobs of dead workers.
+        '''
+        interval = settings.MESSY_FEDIVERSE.get('WORKER_HEARTBEAT_INTERVAL', 15)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                ## Worker might be considered dead if loop was blocked for long
+                await self.save_heartbeat(stopped_at=None)
+                activities, deliveries = await sync_to_async(Worker.reap)()
+                if activities or deliveries:
+                    self.stderr.write(
+                        self.style.WARNING(f"Released jobs of dead workers: {activities} activities, {deliveries} deliveries")
+                    )
+                    ## Released activities may be older than last_id
+                    self._recheck = True
+                    self._notifier.wakeup()
+                ## Debug headers may be left after disabling INBOX_DEBUG_HEADERS
+                await sync_to_async(RequestHeaders.expire)()
+            except Exception as e:
+                self.stderr.write(
+                    self.style.ERROR(f"Heartbeat failed: {e}")
+                )
+                if self.isSqlLostException(e):
+                    await sync_to_async(close_old_connections)()
+    
+    def show_status(self):
+        '''
+        Prints workers and queue status.
+        '''
+        now = timezone.now()
+        claimed_activities = dict(
+            Activity.objects
+                .filter(processing_status=10)
+                .values_list('claimed_by')
+                .annotate(n=Count('pk'))
+        )
+        claimed_deliveries = dict(
+            Delivery.objects
+                .filter(status=Delivery.DELIVERING)
+                .values_list('claimed_by')
+                .annotate(n=Count('pk'))
+        )
+        
+        workers = (
+            Worker.objects
+                .filter(Q(stopped_at__isnull=True) | Q(stopped_at__gte=now - timedelta(days=1)))
+                .order_by('-heartbeat_at')
+        )
+        for worker in workers:
+            if worker.is_alive(now):
+                state = 'alive'
+            elif worker.stopped_at:
+                state = 'stopped'
+            else:
+                state = 'stale'
+            minutes = max(1 / 60, ((worker.stopped_at or worker.heartbeat_at) - worker.started_at).total_seconds() / 60)
+            lag = '-' if worker.delivery_lag is None else f'{worker.delivery_lag:.1f}s'
+            self.stdout.write(
+                f"{worker.worker_id} {state}, heartbeat {(now - worker.heartbeat_at).total_seconds():.0f}s ago, "
+                f"activities {worker.activities_done} ({worker.activities_done / minutes:.1f}/min), "
+                f"deliveries {worker.deliveries_done} ({worker.deliveries_done / minutes:.1f}/min), "
+                f"delivery lag {lag}, "
+                f"claimed {claimed_activities.get(worker.worker_id, 0)} activities, "
+                f"{claimed_deliveries.get(worker.worker_id, 0)} deliveries"
+            )
+        
+        queued = Activity.objects.filter(processing_status=0).count()
+        incoming = IncomingActivity.objects.filter(status=IncomingActivity.QUEUED).count()
+        due = Delivery.objects.filter(status=Delivery.PENDING, next_attempt_at__lte=now).aggregate(n=Count('pk'), oldest=Min('next_attempt_at'))
+        lag = 0
+        if due['oldest']:
+            lag = (now - due['oldest']).total_seconds()
+        self.stdout.write(
+            f"Queue: {incoming} incoming, {queued} activities, {due['n']} deliveries due (lag {lag:.0f}s), "
+            f"{Delivery.objects.filter(status=Delivery.PENDING, next_attempt_at__gt=now).count()} deliveries to retry, "
+            f"{Delivery.objects.filter(status=Delivery.FAILED).count()} failed, "
+            f"{Activity.objects.filter(processing_status=30).count()} failed activities"
+        )
         
-        return asyncio.run(self.ahandle(**options))
+        filtered = inbox_filter().cached_stats()
+        self.stdout.write(
+            'Inbox filter: ' + ', '.join(f'{name} {count}' for name, count in filtered.items())
+        )
     
     async def ahandle(self, *args, **options):
         last_id = 0
@@ -90,15 +292,40 @@ class Command(BaseCommand):
                     ## Forcing last_id recheck
                     last_id = 0
             
+            if self._recheck:
+                self._recheck = False
+                last_id = 0
+            
+            ## Blocked domains are checked before fetching and delivering
+            await domain_blocklist().refresh()
+            
+            ingested = 0
+            if not options['uri']:
+                try:
+                    ingested = await self.ingest(options)
+                except BaseException as e:
+                    self.stderr.write(
+                        self.style.ERROR(f"Processing incoming activities failed: {e}")
+                    )
+                    if self.isSqlLostException(e):
+                        await sync_to_async(close_old_connections)()
+                    else:
+                        raise
+            
+            ## Rows claimed by crashed or stuck workers are claimed again
+            ## when their lease expires.
+            reclaim = (
+                Q(processing_status=10, claim_expires_at__lt=timezone.now())
+                | Q(processing_status=10, claimed_by=self._worker_id)
+            )
+            
             if options['uri']:
                 ## No infinite loop in this case
                 self._done = True
-                await (
-                    Activity.objects
-                        .filter(processing_status=0, object_uri=options['uri'])
-                        .aupdate(processing_status=self._pid)
+                target_ids = await sync_to_async(self.claim)(
+                    Activity.objects.filter(Q(processing_status=0) | reclaim, object_uri=options['uri']),
+                    processing_status=10
                 )
-                qs = Activity.objects.filter(processing_status=self._pid, object_uri=options['uri'])
             else:
                 ## Last ID used for optimization
                 ## so that we don't scan the whole table
@@ -121,131 +348,490 @@ class Command(BaseCommand):
                     last_id = max(1, last_id - self._limit * 5)
                 
                 ## Marking these items for processing
-                target_ids = (
+                target_ids = await sync_to_async(self.claim)(
                     Activity.objects
-                        .filter(processing_status=0, pk__gte=last_id)
-                        .order_by('-pk')
-                        .values_list('pk', flat=True)[:self._limit]
+                        .filter(Q(processing_status=0, pk__gte=last_id) | reclaim)
+                        .order_by('-pk'),
+                    processing_status=10
                 )
-                target_ids = [pk async for pk in target_ids]
-                await (
-                    Activity.objects
-                        .filter(processing_status=0, pk__in=target_ids)
-                        .aupdate(processing_status=self._pid)
-                )
-                qs = Activity.objects.filter(processing_status=self._pid).order_by('pk')
             
-            found = False
-            async for activity in qs:
-                found = True
-                
+            qs = Activity.objects.filter(pk__in=target_ids, claimed_by=self._worker_id).order_by('pk')
+            activities = [activity async for activity in qs]
+            ## Activities saved by ingest() are newer than last_id
+            found = bool(activities) or bool(ingested)
+            await self.process_activities(activities, options)
+            
+            try:
+                await self.resolve_threads(options)
+            except BaseException as e:
+                if self.isSqlLostException(e):
+                    await sync_to_async(close_old_connections)()
+                else:
+                    raise
+            
+            try:
+                await self.deliver_due(options['uri'])
+            except BaseException as e:
                 self.stderr.write(
-                    self.style.SUCCESS(f"DEBUG: Processing: #{activity.pk} {activity}")
+                    self.style.ERROR(f"Delivering failed: {e}")
                 )
-                
-                ## If is outgoing
-                if not activity.incoming:
-                    try:
-                        result = await self.federate(self._request, self._actor, activity)
-                        self.stderr.write(
-                            self.style.SUCCESS(f"DEBUG: Federated activity: {result}")
-                        )
-                    except BaseException as e:
-                        self.stderr.write(
-                            self.style.ERROR(f"Federating failed: #{activity.pk} {activity}: {e}")
-                        )
-                        if self.isSqlLostException(e):
-                            ## Got exception
-                            ## 'Lost connection to MySQL server during query'
-                            ## Will retry in next iteration
-                            await sync_to_async(close_old_connections)()
-                            continue
-                        else:
-                            raise
-                
-                try:
-                    result = await Replies.fetch_parents(self._request, activity.object_uri)
-                    if (
-                        type(result) is dict
-                        and 'root' in result
-                        and type(result['root']) is dict
-                        and 'object' in result['root']
-                        and type(result['root']['object']) is dict
-                        and 'id' in result['root']['object']
-                    ):
-                        result = result['root']['object']['id']
-                        self.stderr.write(
-                            self.style.SUCCESS(f"DEBUG: Fetched root: {result}")
-                        )
-                    else:
-                        self.stderr.write(
-                            self.style.WARNING(f"ERROR: couldn't fetch root for: {activity.object_uri}")
-                        )
-                
-                except BaseException as e:
-                    self.stderr.write(
-                        self.style.ERROR(f"ERROR: Fetching root failed: #{activity.pk} {activity}: {e}")
-                    )
-                    if self.isSqlLostException(e):
-                        ## Got exception
-                        ## 'Lost connection to MySQL server during query'
-                        ## Will retry in next iteration
-                        await sync_to_async(close_old_connections)()
-                        continue
-                    else:
-                        raise
-                
-                is_done = True
-                
-                ## If is outgoing
-                if not activity.incoming:
-                    # activity.refresh_from_db()
-                    ## Until django 5.1 it requires sync_to_async,
-                    ## so using aget instead.
-                    activity = await Activity.objects.aget(pk=activity.pk)
-                    activity_dict = activity.get_dict()
-                    is_done = not self.isFederatingNeeded(activity_dict)
-                    if not is_done:
-                        self.stderr.write(
-                            self.style.WARNING(f"Will retry activity: #{activity.pk} {activity}")
-                        )
-                
-                if is_done:
-                    ## Processing done
-                    await Activity.objects.filter(pk=activity.pk).aupdate(processing_status=-self._pid)
-                    self.stderr.write(
-                        self.style.SUCCESS(f"Done activity: #{activity.pk} {activity}")
-                    )
-                
-                self.stderr.flush()
-                
+                if self.isSqlLostException(e):
+                    await sync_to_async(close_old_connections)()
+                else:
+                    raise
+            
+            self.stderr.flush()
+            
+            if self._done:
+                break
+            
+            if found:
+                ## There may be more work queued
                 if options['sleep']:
                     await asyncio.sleep(options['sleep'])
+            else:
+                await self._notifier.wait(await self.idle_timeout(options))
+    
+    async def idle_timeout(self, options):
+        '''
+        How long to wait for notification when there is nothing to do.
+        Returns seconds.
+        '''
+        if self._notifier.listening:
+            timeout = settings.MESSY_FEDIVERSE.get('WORKER_POLL_INTERVAL', 60)
+        else:
+            ## No notifications, polling
+            timeout = (options['sleep'] or 1) + 1
+        
+        ## Waking up for deliveries to retry
+        next_attempt_at = await (
+            Delivery.objects
+                .filter(status=Delivery.PENDING)
+                .order_by('next_attempt_at')
+                .values_list('next_attempt_at', flat=True)
+                .afirst()
+        )
+        if next_attempt_at:
+            timeout = min(timeout, max(1, (next_attempt_at - timezone.now()).total_seconds()))
+        
+        return timeout
+    
+    def claim(self, queryset, **values):
+        '''
+        Claims up to _limit rows of queryset for this worker.
+        Rows locked by other workers are skipped, so several workers
+        may run against one database.
+        queryset: QuerySet of model with claimed_by and claim_expires_at fields.
+        **values: other fields to update in claimed rows.
+        Returns list of claimed pks.
+        '''
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            else:
+                ## Older MariaDB/MySQL, waiting for locks
+                queryset = queryset.select_for_update()
             
-            await asyncio.sleep((options['sleep'] or 1) + 1)
+            target_ids = list(queryset.values_list('pk', flat=True)[:self._limit])
+            if target_ids:
+                self._claimed_at = monotonic()
+                queryset.model.objects.filter(pk__in=target_ids).update(
+                    claimed_by=self._worker_id,
+                    claim_expires_at=timezone.now() + timedelta(seconds=self._lease),
+                    **values
+                )
+        return target_ids
+    
+    async def renew_claims(self):
+        '''
+        Extends lease of claimed activities if batch takes long.
+        '''
+        if monotonic() - self._claimed_at < self._lease / 2:
+            return
+        self._claimed_at = monotonic()
+        await (
+            Activity.objects
+                .filter(processing_status=10, claimed_by=self._worker_id)
+                .aupdate(claim_expires_at=timezone.now() + timedelta(seconds=self._lease))
+        )
+    
+    async def ingest(self, options):
+        '''
+        Processes activities received by inbox in queue mode (INBOX_QUEUE setting):
+        fetches author info, saves activity, handles follows, sends notices.
+        Returns number of processed items.
+        '''
+        max_attempts = settings.MESSY_FEDIVERSE.get('INBOX_QUEUE_MAX_ATTEMPTS', 5)
+        target_ids = await sync_to_async(self.claim)(
+            IncomingActivity.objects
+                .filter(
+                    Q(status=IncomingActivity.QUEUED)
+                    | Q(status=IncomingActivity.PROCESSING, claim_expires_at__lt=timezone.now())
+                    | Q(status=IncomingActivity.PROCESSING, claimed_by=self._worker_id)
+                )
+                .order_by('pk'),
+            status=IncomingActivity.PROCESSING
+        )
+        if not target_ids:
+            return 0
+        
+        items = [
+            item async for item in
+            IncomingActivity.objects.filter(pk__in=target_ids, claimed_by=self._worker_id).order_by('pk')
+        ]
+        semaphore = asyncio.Semaphore(max(1, options['concurrency'] or 1))
+        
+        async def process(item):
+            async with semaphore:
+                self.stderr.write(
+                    self.style.SUCCESS(f"DEBUG: Processing incoming: #{item.pk} {item.uri}")
+                )
+                return await process_incoming(self._request, item.data)
+        
+        results = await asyncio.gather(*[process(item) for item in items], return_exceptions=True)
+        
+        done = []
+        failed = []
+        for item, result in zip(items, results):
+            if isinstance(result, BaseException):
+                if self.isSqlLostException(result):
+                    ## Item stays claimed and will be processed again
+                    continue
+                self.stderr.write(
+                    self.style.ERROR(f"Processing incoming failed: #{item.pk} {item.uri}: {result!r}")
+                )
+                item.attempts += 1
+                item.last_error = repr(result)
+                item.status = IncomingActivity.FAILED if item.attempts >= max_attempts else IncomingActivity.QUEUED
+                item.claim_expires_at = None
+                failed.append(item)
+            else:
+                done.append(item.pk)
+        
+        if done:
+            await IncomingActivity.objects.filter(pk__in=done).adelete()
+        if failed:
+            await IncomingActivity.objects.abulk_update(failed, ['attempts', 'last_error', 'status', 'claim_expires_at'])
+        
+        self.stderr.flush()
+        return len(done) + len(failed)
+    
+    async def process_activities(self, activities, options):
+        '''
+        Processes activities, up to --concurrency at once.
+        Failure of one activity doesn't stop others.
+        activities: list of models.Activity instances.
+        '''
+        semaphore = asyncio.Semaphore(max(1, options['concurrency'] or 1))
+        
+        async def process(activity):
+            async with semaphore:
+                return await self.process_activity(activity, options)
+        
+        results = await asyncio.gather(*[process(activity) for activity in activities], return_exceptions=True)
+        
+        failed = []
+        for activity, result in zip(activities, results):
+            if isinstance(result, BaseException):
+                self.stderr.write(
+                    self.style.ERROR(f"Processing failed: #{activity.pk} {activity}: {result!r}")
+                )
+                failed.append(activity.pk)
+        
+        try:
+            await self.finish_activities([activity for activity, result in zip(activities, results) if result is True])
+            if failed:
+                ## Not claimed again when lease expires,
+                ## may be queued again by setting status to 0.
+                await (
+                    Activity.objects
+                        .filter(pk__in=failed, claimed_by=self._worker_id)
+                        .aupdate(processing_status=30, claim_expires_at=None)
+                )
+        except BaseException as e:
+            if self.isSqlLostException(e):
+                ## Activities stay claimed and will be processed again
+                await sync_to_async(close_old_connections)()
+            else:
+                raise
+    
+    async def finish_activities(self, activities):
+        '''
+        Marks processed activities done, queues thread resolution if needed.
+        activities: list of models.Activity instances.
+        '''
+        if not activities:
+            return
+        
+        unresolved = await self.unresolved_threads(activities)
+        for thread_status, pks in (
+            (1, [activity.pk for activity in activities if activity.pk in unresolved]),
+            (0, [activity.pk for activity in activities if activity.pk not in unresolved]),
+        ):
+            if pks:
+                await (
+                    Activity.objects
+                        .filter(pk__in=pks, claimed_by=self._worker_id)
+                        .aupdate(processing_status=20, thread_status=thread_status, claim_expires_at=None)
+                )
+        
+        self._stats['activities'] += len(activities)
+    
+    async def process_activity(self, activity, options):
+        '''
+        Processes claimed activity, its status is saved by finish_activities().
+        activity: models.Activity instance.
+        Returns False if activity should be processed again in next cycle.
+        '''
+        await self.renew_claims()
+        
+        self.stderr.write(
+            self.style.SUCCESS(f"DEBUG: Processing: #{activity.pk} {activity}")
+        )
+        
+        ## If is outgoing
+        if not activity.incoming:
+            try:
+                result = await self.federate(self._request, self._actor, activity)
+                self.stderr.write(
+                    self.style.SUCCESS(f"DEBUG: Federated activity: {result}")
+                )
+            except BaseException as e:
+                self.stderr.write(
+                    self.style.ERROR(f"Federating failed: #{activity.pk} {activity}: {e}")
+                )
+                if self.isSqlLostException(e):
+                    ## Got exception
+                    ## 'Lost connection to MySQL server during query'
+                    ## Will retry in next iteration
+                    await sync_to_async(close_old_connections)()
+                    return False
+                else:
+                    raise
+        
+        self.stderr.write(
+            self.style.SUCCESS(f"Done activity: #{activity.pk} {activity}")
+        )
+        
+        self.stderr.flush()
+        
+        if options['sleep']:
+            await asyncio.sleep(options['sleep'])
+        
+        return True
+    
+    async def unresolved_threads(self, activities):
+        '''
+        Finds activities which thread root should be resolved,
+        it's needed for created/updated replies with parent not known locally.
+        activities: list of models.Activity instances.
+        Returns set of activities pks.
+        '''
+        replies = [
+            activity for activity in activities
+            if activity.activity_type in ('CRE', 'UPD') and activity.in_reply_to_uri
+        ]
+        if not replies:
+            return set()
+        
+        parents = Activity.objects.filter(
+            Q(activity_type='CRE') | Q(activity_type='UPD'),
+            disabled=False,
+            object_uri__in={activity.in_reply_to_uri for activity in replies},
+        ).order_by('pk').values_list('object_uri', 'context')
+        ## Latest activity of object wins
+        parents = {object_uri: context async for object_uri, context in parents}
+        
+        ## Parent's thread is already resolved if it's in the same context
+        return {
+            activity.pk for activity in replies
+            if parents.get(activity.in_reply_to_uri) != activity.context
+        }
+    
+    async def resolve_threads(self, options):
+        '''
+        Resolves thread roots of activities queued by process_activity(),
+        once per thread.
+        Returns number of resolved activities.
+        '''
+        reclaim = Q(thread_status=2, claim_expires_at__lt=timezone.now()) | Q(thread_status=2, claimed_by=self._worker_id)
+        qs = Activity.objects.filter(Q(thread_status=1) | reclaim)
+        if options['uri']:
+            qs = qs.filter(object_uri=options['uri'])
+        target_ids = await sync_to_async(self.claim)(qs.order_by('pk'), thread_status=2)
+        if not target_ids:
+            return 0
+        
+        threads = {}
+        async for activity in Activity.objects.filter(pk__in=target_ids, claimed_by=self._worker_id).order_by('-pk'):
+            threads.setdefault(activity.context or activity.pk, []).append(activity)
+        
+        semaphore = asyncio.Semaphore(max(1, options['concurrency'] or 1))
+        
+        async def resolve(activities):
+            async with semaphore:
+                ## Latest reply first, others usually have their parents
+                ## fetched by this time.
+                await self.fetch_thread(activities[0])
+                if len(activities) > 1:
+                    unresolved = await self.unresolved_threads(activities[1:])
+                    for activity in activities[1:]:
+                        if activity.pk in unresolved:
+                            await self.fetch_thread(activity)
+        
+        threads = list(threads.values())
+        results = await asyncio.gather(*[resolve(activities) for activities in threads], return_exceptions=True)
+        
+        resolved = [activity.pk for activities, result in zip(threads, results) if result is None for activity in activities]
+        if resolved:
+            await (
+                Activity.objects
+                    .filter(pk__in=resolved, claimed_by=self._worker_id)
+                    .aupdate(thread_status=0, claim_expires_at=None)
+            )
+        
+        failed = []
+        for activities, result in zip(threads, results):
+            if isinstance(result, BaseException):
+                self.stderr.write(
+                    self.style.ERROR(f"ERROR: Fetching root failed: #{activities[0].pk} {activities[0]}: {result!r}")
+                )
+                if self.isSqlLostException(result):
+                    ## Will retry in next iteration
+                    await sync_to_async(close_old_connections)()
+                else:
+                    failed += [activity.pk for activity in activities]
+        
+        if failed:
+            ## Not retried, so that broken thread doesn't stop the worker
+            await (
+                Activity.objects
+                    .filter(pk__in=failed, claimed_by=self._worker_id)
+                    .aupdate(thread_status=-1, claim_expires_at=None)
+            )
+        
+        return len(target_ids)
+    
+    async def fetch_thread(self, activity):
+        result = await Replies.fetch_parents(self._request, activity.object_uri)
+        if (
+            type(result) is dict
+            and 'root' in result
+            and type(result['root']) is dict
+            and 'object' in result['root']
+            and type(result['root']['object']) is dict
+            and 'id' in result['root']['object']
+        ):
+            result = result['root']['object']['id']
+            self.stderr.write(
+                self.style.SUCCESS(f"DEBUG: Fetched root: {result}")
+            )
+        else:
+            self.stderr.write(
+                self.style.WARNING(f"ERROR: couldn't fetch root for: {activity.object_uri}")
+            )
     
     async def federate(self, request, actor, activity):
         '''Federate job function.
+        Resolves inboxes of activity and queues deliveries.
         request: django request object.
         actor: fediverse.FediverseActor instance.
         activity: models.Activity instance.
         '''
-        now = datetime.now()
         activity_dict = activity.get_dict()
-        activity_ts = datetime.fromisoformat(
-            activity_dict.get('published', '1970-01-01').replace('Z', '')
-        )
         
-        if not self.isFederatingNeeded(activity_dict):
-            ## Already federated or too old
+        legacy_inboxes = self.legacyFailedInboxes(activity_dict)
+        if legacy_inboxes and not await activity.deliveries.aexists():
+            ## Federated by older version, some deliveries failed
+            ## and should be retried.
+            await Delivery.objects.abulk_create(
+                [
+                    Delivery(activity=activity, inbox=inbox, attempts=activity_dict['_requestAttempt'])
+                    for inbox in legacy_inboxes
+                ],
+                ignore_conflicts=True
+            )
+            self.stderr.write(
+                self.style.SUCCESS(f"DEBUG: Queued {len(legacy_inboxes)} failed deliveries of older version: #{activity.pk} {activity}")
+            )
+            return None
+        
+        if not self.isFederatingNeeded(activity_dict) or await activity.deliveries.aexists():
+            ## Already federated
             self.stderr.write(
                 self.style.SUCCESS(f"DEBUG: NOT federating: #{activity.pk} {activity}")
             )
             return None
         
         activity_dict = await actor.prepare_activity(activity_dict)
-        activity_dict = await actor.federate(activity_dict)
-        return await save_activity(request, activity_dict)
+        endpoints = await actor.federation_endpoints(activity_dict)
+        ## Saving recipients added by federation_endpoints()
+        result = await save_activity(request, activity_dict)
+        await Delivery.objects.abulk_create(
+            [Delivery(activity=activity, inbox=endpoint) for endpoint in endpoints],
+            ignore_conflicts=True
+        )
+        return result
+    
+    async def deliver_due(self, uri=None):
+        '''
+        Sends pending deliveries which are due.
+        uri: optional object URI to deliver activities of.
+        Returns number of processed deliveries.
+        '''
+        now = timezone.now()
+        qs = Delivery.objects.filter(
+            Q(status=Delivery.PENDING, next_attempt_at__lte=now)
+            | Q(status=Delivery.DELIVERING, claim_expires_at__lt=now)
+        )
+        if uri:
+            qs = qs.filter(activity__object_uri=uri)
+        
+        target_ids = await sync_to_async(self.claim)(qs.order_by('next_attempt_at'), status=Delivery.DELIVERING)
+        if not target_ids:
+            return 0
+        
+        deliveries = {}
+        async for delivery in Delivery.objects.filter(pk__in=target_ids, claimed_by=self._worker_id).select_related('activity'):
+            deliveries.setdefault(delivery.activity_id, []).append(delivery)
+        
+        await asyncio.gather(*[self.deliver_activity(items) for items in deliveries.values()])
+        
+        deliveries = [delivery for items in deliveries.values() for delivery in items]
+        await Delivery.objects.abulk_update(
+            deliveries,
+            ['status', 'attempts', 'next_attempt_at', 'last_attempt_at', 'last_error', 'claim_expires_at']
+        )
+        return len(deliveries)
+    
+    async def deliver_activity(self, deliveries):
+        '''
+        Sends one activity to inboxes.
+        deliveries: list of Delivery instances of the same activity.
+        '''
+        activity = deliveries[0].activity
+        try:
+            results = await self._actor.deliver(activity.get_dict(), [d.inbox for d in deliveries])
+        except Exception as e:
+            self.stderr.write(
+                self.style.ERROR(f"Delivering failed: #{activity.pk} {activity}: {e}")
+            )
+            results = [{'error': repr(e), 'attempted': True}] * len(deliveries)
+        
+        now = timezone.now()
+        for delivery, result in zip(deliveries, results):
+            self._stats['deliveries'] += 1
+            self._stats['lag_total'] += max(0, (now - delivery.next_attempt_at).total_seconds())
+            self._stats['lag_count'] += 1
+            delivery.record_result(result, now)
+            if delivery.status == Delivery.FAILED:
+                self.stderr.write(
+                    self.style.ERROR(f"Delivery failed: #{activity.pk} {delivery}: {delivery.last_error}")
+                )
+            elif delivery.status == Delivery.PENDING:
+                self.stderr.write(
+                    self.style.WARNING(f"Will retry delivery: #{activity.pk} {delivery}")
+                )
     
     @staticmethod
     def isSqlLostException(exception):
@@ -258,17 +844,23 @@ class Command(BaseCommand):
     
     @staticmethod
     def isFederatingNeeded(activity_dict):
-        '''Check if should retry to federate
+        '''Check if activity wasn't federated yet
         activity_dict: dict'''
+        ## Activities federated by older versions have delivery
+        ## info stored in activity data.
+        return '_requestAttempt' not in activity_dict
+    
+    @staticmethod
+    def legacyFailedInboxes(activity_dict):
+        '''Get inboxes which older versions failed to deliver activity to
+        and would retry.
+        activity_dict: dict
+        Returns list of inbox URLs.'''
         if (
-            '_requestAttempt' not in activity_dict
-            or (
-                ## There are failed requests and not attempt done
-                activity_dict['_requestAttempt'] < 3
-                and len(activity_dict.get('_failedRequests', {}))
-            )
+            type(activity_dict.get('_requestAttempt')) is int
+            and activity_dict['_requestAttempt'] < 3
+            and type(activity_dict.get('_failedRequests')) is dict
         ):
-            return True
-        
-        return False
-    
+            return list(activity_dict['_failedRequests'])
+        return []
+
@@ -3,30 +3,26 @@ from django.http import JsonResponse
 from django.core.exceptions import PermissionDenied #, BadRequest
 from .controller import fediverse_factory, root_json, request_user_is_staff, ActivityResponse
 from .models import Activity
+from .inbox import inbox_filter, request_json, self_delete_actor, known_actors, forget_actor, InboxRateLimiter, actor_id, url_host
+from .blocklist import domain_blocklist
+from .log import stderrlog
 from django.conf import settings
+from django.core.cache import cache
 from django.urls import resolve, reverse
 from hashlib import sha256
 from base64 import b64encode, b64decode
 from .urls import app_name
 import re
-import sys
 from datetime import datetime
+from math import ceil
+from time import monotonic
+from collections import OrderedDict
 from django.utils.decorators import sync_and_async_middleware
 import aiohttp
 from asgiref.sync import async_to_sync
 from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from functools import wraps
 
-def stderrlog(*msg):
-    if (
-        settings.MESSY_FEDIVERSE.get('DEBUG', False)
-        or settings.DEBUG
-        or 'error' in msg or 'ERROR' in msg
-        or 'warning' in msg or 'WARNING' in msg
-    ):
-        print(*msg, file=sys.stderr, flush=True)
-
-
 class StdErrLogAllRequests:
     '''
     Log all requests to stderr
@@ -172,6 +168,79 @@ class WrapIntoStatus:
         
         return response
 
+class PublicKeyStore:
+    '''
+    Parsed remote public keys by keyId.
+    Keys expire after TTL, least recently used keys are evicted
+    when store is full.
+    '''
+    def __init__(self, ttl=3600, maxsize=1024, refetch_interval=60):
+        '''
+        refetch_interval: int, min seconds between refetches of one key
+        '''
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.refetch_interval = refetch_interval
+        self.__keys__ = OrderedDict()
+        ## key id: time of last refetch
+        self.__refetched__ = OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'refetches': 0,
+            'refetches_skipped': 0,
+        }
+    
+    def get(self, key_id):
+        '''
+        Returns key object or None if not stored or expired.
+        '''
+        item = self.__keys__.get(key_id)
+        if item is None:
+            self.stats['misses'] += 1
+            return None
+        
+        key, expires = item
+        if expires < monotonic():
+            del(self.__keys__[key_id])
+            self.stats['misses'] += 1
+            return None
+        
+        self.__keys__.move_to_end(key_id)
+        self.stats['hits'] += 1
+        return key
+    
+    def set(self, key_id, key):
+        self.__keys__[key_id] = (key, monotonic() + self.ttl)
+        self.__keys__.move_to_end(key_id)
+        while len(self.__keys__) > self.maxsize:
+            self.__keys__.popitem(last=False)
+        return key
+    
+    def discard(self, key_id):
+        self.__keys__.pop(key_id, None)
+    
+    def may_refetch(self, key_id):
+        '''
+        Checks if key may be fetched again (e.g. signature verification
+        failed, key might be rotated) and counts refetch.
+        Keys are refetched not more than once per refetch_interval,
+        so that requests with bad signatures don't make us fetch keys
+        again and again.
+        '''
+        now = monotonic()
+        refetched = self.__refetched__.get(key_id)
+        if refetched is not None and now - refetched < self.refetch_interval:
+            self.stats['refetches_skipped'] += 1
+            return False
+        
+        self.__refetched__[key_id] = now
+        self.__refetched__.move_to_end(key_id)
+        while len(self.__refetched__) > self.maxsize:
+            self.__refetched__.popitem(last=False)
+        self.stats['refetches'] += 1
+        return True
+
 # @sync_and_async_middleware
 class VerifySignature:
     '''
@@ -182,21 +251,53 @@ class VerifySignature:
     
     def __init__(self, get_response):
         self.get_response = get_response
+        self.public_keys = PublicKeyStore(
+            ttl=settings.MESSY_FEDIVERSE.get('PUBKEY_CACHE_TTL', 3600),
+            maxsize=settings.MESSY_FEDIVERSE.get('PUBKEY_CACHE_SIZE', 1024),
+            refetch_interval=settings.MESSY_FEDIVERSE.get('PUBKEY_REFETCH_INTERVAL', 60)
+        )
+        self.rate_limiter = InboxRateLimiter(
+            rate=settings.MESSY_FEDIVERSE.get('INBOX_RATE_LIMIT', 10),
+            burst=settings.MESSY_FEDIVERSE.get('INBOX_RATE_BURST', 200),
+            cache=cache
+        )
         if iscoroutinefunction(self.get_response):
             markcoroutinefunction(self)
     
     async def __call__(self, request):
         ## Calling next middleware or view if no errors above
-        return await self.get_response(request)
+        response = await self.get_response(request)
+        await inbox_filter().flush_stats()
+        return response
     
     async def process_view(self, request, view_func, view_args, view_kwargs):
         ## Whe check only views which have csrf_exempt because only those views
         ## are for requests from federated instances.
-        if (
-            request.method == 'POST' and not await request_user_is_staff(request)
+        if not (
+            request.method == 'POST'
             and getattr(view_func, 'csrf_exempt', False) and request.resolver_match
             and request.resolver_match.app_name == app_name
-            and not settings.MESSY_FEDIVERSE.get('NO_VERIFY_SIGNATURE', False)
+        ):
+            return None
+        
+        throttled = await self.throttle(request)
+        if throttled is not None:
+            return throttled
+        
+        await domain_blocklist().refresh()
+        
+        ## Before any crypto, network or DB work
+        filtered = self.prefilter(request)
+        if filtered is not None:
+            return filtered
+        
+        deleted = await self.actor_deleted(request)
+        if deleted is not None:
+            return deleted
+        
+        if (
+            not settings.MESSY_FEDIVERSE.get('NO_VERIFY_SIGNATURE', False)
+            and not await request_user_is_staff(request)
         ):
             digest = request.headers.get('digest')
             if not digest:
@@ -220,61 +321,32 @@ class VerifySignature:
             if signature.get('algorithm', 'rsa-sha256') not in ('sha256', 'rsa-sha256'):
                 return self.response_error(request, 'Unsupported signature algorithm')
             
-            actor = None
             fediverse = fediverse_factory(request)
             
-            try:
-                actor = await fediverse.aget(signature['keyId'])
-            except BaseException as e:
-                if settings.DEBUG:
-                    ## Raise original exception (probably HTTPError)
-                    raise e
-                else:
-                    raise PermissionDenied(*e.args)
-            
-            if type(actor) is not dict:
-                return self.response_error(request, f'Actor verify failed: {type(actor)} {actor}')
+            ## Trying stored key first. If verification fails with it,
+            ## key is fetched again bypassing cache, it might be rotated.
+            actorKey = self.public_keys.get(signature['keyId'])
+            nocache = False
             
-            actorKey = actor.get('publicKey', None)
-            if not actorKey:
-                return self.response_error(request, 'No actor public key.')
-            
-            if 'id' not in actorKey or actorKey['id'] != signature['keyId']:
-                return self.response_error(request, 'Bad actor key ID')
-            
-            
-            verify_errors = []
-            try_paths = []
-            if request.META.get('QUERY_STRING'):
-                try_paths.append(request.path + '?' + request.META.get('QUERY_STRING'))
-            try_paths.append(request.path)
-            
-            ## Trying to verify signature for path with query string and without
-            ## In the past path without query string was proper signature
-            ## but mastodon began to use query string for signatures at some time
-            for path in try_paths:
-                str2sign = []
-            
-                for h in signature['headers']:
-                    if h == '(request-target)':
-                        v = f'post {path}'
-                    else:
-                        v  = request.headers.get(h, '')
-                    
-                    str2sign.append(f'{h}: {v}')
+            while True:
+                if actorKey is None:
+                    actorKey = await self.fetch_public_key(request, fediverse, signature['keyId'], nocache=nocache)
+                    if not hasattr(actorKey, 'verify'):
+                        ## Got error response
+                        return actorKey
+                
+                verify_errors = self.verify(request, fediverse, signature, actorKey)
+                if not len(verify_errors) or nocache:
+                    break
                 
-                str2sign = '\n'.join(str2sign)
+                if not self.public_keys.may_refetch(signature['keyId']):
+                    ## Key was refetched recently
+                    break
                 
-                try:
-                    verifyResult = fediverse.crypt_verify(str2sign, signature['signature'], actorKey.get('publicKeyPem'))
-                    if verifyResult is None:
-                        ## Signature check successful
-                        verify_errors.clear()
-                        break
-                except BaseException as e:
-                    if not len(e.args):
-                        e.args = (str2sign, signature['signature'], actorKey.get('publicKeyPem'), request.META.get('HTTP_REMOTE_ADDR'), request.headers.get('user-agent'))
-                    verify_errors.append(e)
+                ## Retrying once with fresh key, stored key
+                ## is replaced if fetched successfully
+                actorKey = None
+                nocache = True
             
             if len(verify_errors):
                 error_text = ', '.join(map(repr, verify_errors))
@@ -288,6 +360,173 @@ class VerifySignature:
         ## Continue normal process
         return None
     
+    @property
+    def stats(self):
+        return {
+            'public_keys': self.public_keys.stats.copy(),
+            'rate_limit': self.rate_limiter.stats.copy(),
+            'throttled_hosts': dict(self.rate_limiter.throttled_hosts),
+        }
+    
+    async def throttle(self, request):
+        '''
+        Limits rate of requests from remote host (signature keyId or actor).
+        Returns 429 response if host sends too many requests, or None.
+        '''
+        signature_string = request.headers.get('signature', None)
+        if not signature_string:
+            return None
+        
+        host = url_host(self.parse_signature(signature_string).get('keyId'))
+        if not host:
+            data = request_json(request)
+            host = data and url_host(actor_id(data))
+        
+        wait = await self.rate_limiter.take(host)
+        if not wait:
+            return None
+        
+        inbox_filter().count('throttled')
+        stderrlog('DEBUG', 'INBOX THROTTLED:', host, wait)
+        response = JsonResponse({'success': False, 'status': 'throttled'}, status=429)
+        response['Retry-After'] = str(ceil(wait))
+        return response
+    
+    def prefilter(self, request):
+        '''
+        Applies inbox filter rules.
+        Returns response if request should not be processed, or None.
+        '''
+        signature_string = request.headers.get('signature', None)
+        if not signature_string:
+            ## Not from federated instance (e.g. staff)
+            return None
+        key_id = self.parse_signature(signature_string).get('keyId')
+        
+        result = inbox_filter().check(request, key_id)
+        if result is None:
+            return None
+        
+        rule, action = result
+        stderrlog('DEBUG', 'INBOX FILTER:', rule, action, key_id)
+        if action == 'ack':
+            return JsonResponse({'success': True, 'status': 'ignored'}, status=202)
+        return JsonResponse({'success': False, 'status': 'rejected'}, status=403)
+    
+    async def actor_deleted(self, request):
+        '''
+        Fast path for actors deleting own accounts, their keys are gone
+        so signatures can't be verified anyway.
+        Unknown actors are just acknowledged. For known ones, deletion
+        is confirmed by remote server (410 or 404 for actor),
+        then cached data and follower rows of actor are removed.
+        Returns response or None if request should be verified as usual.
+        '''
+        if not request.headers.get('signature'):
+            return None
+        
+        data = request_json(request)
+        actor = data and self_delete_actor(data)
+        if not actor:
+            return None
+        
+        fediverse = fediverse_factory(request)
+        cached = await fediverse.cache_get(actor)
+        if (
+            (cached is None or fediverse.is_negative_cache_entry(cached))
+            and not await known_actors().contains(actor)
+        ):
+            inbox_filter().count('deletes_unknown')
+            return JsonResponse({'success': True, 'status': 'ignored'}, status=202)
+        
+        if not await fediverse.is_deleted(actor):
+            ## Actor still exists, may be a forgery
+            return None
+        
+        inbox_filter().count('deletes_known')
+        self.public_keys.discard(self.parse_signature(request.headers['signature']).get('keyId'))
+        await forget_actor(fediverse, actor, cached)
+        return JsonResponse({'success': True, 'status': 'deleted'}, status=202)
+    
+    async def fetch_public_key(self, request, fediverse, key_id, nocache=False):
+        '''
+        Get actor's public key and store it parsed.
+        key_id: string, signature keyId
+        nocache: bool, bypass requests cache
+        Returns key object or error response.
+        '''
+        actor = None
+        
+        try:
+            ## One failed fetch shouldn't make all requests of actor
+            ## fail for a while, so failures aren't cached.
+            actor = await fediverse.aget(key_id, nocache=nocache, negative_cache=False)
+        except BaseException as e:
+            if settings.DEBUG:
+                ## Raise original exception (probably HTTPError)
+                raise e
+            else:
+                raise PermissionDenied(*e.args)
+        
+        if type(actor) is not dict:
+            return self.response_error(request, f'Actor verify failed: {type(actor)} {actor}')
+        
+        actorKey = actor.get('publicKey', None)
+        if not actorKey:
+            return self.response_error(request, 'No actor public key.')
+        
+        if 'id' not in actorKey or actorKey['id'] != key_id:
+            return self.response_error(request, 'Bad actor key ID')
+        
+        try:
+            key = fediverse.crypt_load_public_key(actorKey.get('publicKeyPem'))
+        except BaseException as e:
+            return self.response_error(request, f'Bad actor public key: {e!r}')
+        
+        return self.public_keys.set(key_id, key)
+    
+    def verify(self, request, fediverse, signature, key):
+        '''
+        Verify request signature.
+        signature: dict, parsed signature header
+        key: public key object
+        Returns list of errors, empty if signature is valid.
+        '''
+        verify_errors = []
+        try_paths = []
+        if request.META.get('QUERY_STRING'):
+            try_paths.append(request.path + '?' + request.META.get('QUERY_STRING'))
+        try_paths.append(request.path)
+        
+        ## Trying to verify signature for path with query string and without
+        ## In the past path without query string was proper signature
+        ## but mastodon began to use query string for signatures at some time
+        for path in try_paths:
+            str2sign = []
+            
+            for h in signature['headers']:
+                if h == '(request-target)':
+                    v = f'post {path}'
+                else:
+                    v  = request.headers.get(h, '')
+                
+                str2sign.append(f'{h}: {v}')
+            
+            str2sign = '\n'.join(str2sign)
+            
+            try:
+                verifyResult = fediverse.crypt_verify(str2sign, signature['signature'], key)
+                if verifyResult is None:
+                    ## Signature check successful
+                    verify_errors.clear()
+                    break
+            except BaseException as e:
+                if not len(e.args):
+                    e.args = (str2sign, signature['signature'], signature['keyId'], request.META.get('HTTP_REMOTE_ADDR'), request.headers.get('user-agent'))
+                verify_errors.append(e)
+        
+        return verify_errors
+    
     @staticmethod
     def response_error(request, message):
         error = message
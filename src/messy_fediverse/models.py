@@ -2,7 +2,9 @@ from django.db import models
 from django.conf import settings
 from os import path
 import json
-from datetime import datetime
+from random import random
+from datetime import datetime, timedelta
+from django.utils import timezone
 from .fediverse import FediverseActor
 
 def get_upload_path(self, filename):
@@ -18,11 +20,90 @@ def get_upload_path(self, filename):
 class FederatedEndpoint(models.Model):
     uri = models.URLField('URL', unique=True, null=False, blank=False)
     disabled = models.BooleanField('Disabled', default=False, null=False)
+    ## Delivery health stats
+    consecutive_failures = models.PositiveIntegerField('Consecutive failures', default=0, null=False)
+    last_success_at = models.DateTimeField('Last success', null=True, blank=True)
+    last_failure_at = models.DateTimeField('Last failure', null=True, blank=True)
+    failing_since = models.DateTimeField('Failing since', null=True, blank=True)
+    last_latency = models.FloatField('Last latency (seconds)', null=True, blank=True)
+    last_error = models.TextField('Last error', default='', blank=True)
+    ## Failing endpoint is skipped until this time
+    next_probe_at = models.DateTimeField('Next probe', null=True, blank=True)
+    
     def __str__(self):
         name = ''
         if self.disabled:
             name = '[X] '
+        elif self.next_probe_at:
+            name = '[!] '
         return name + self.uri
+    
+    @staticmethod
+    def health_option(name, default):
+        return settings.MESSY_FEDIVERSE.get(name, default)
+    
+    def is_available(self, now=None):
+        '''
+        Returns False if endpoint is failing and it's not time to probe it yet.
+        '''
+        if self.disabled:
+            return False
+        if self.next_probe_at is None:
+            return True
+        return self.next_probe_at <= (now or timezone.now())
+    
+    def record_success(self, latency=None, now=None):
+        self.consecutive_failures = 0
+        self.failing_since = None
+        self.last_success_at = now or timezone.now()
+        self.last_latency = latency
+        self.next_probe_at = None
+    
+    def record_failure(self, error, latency=None, now=None):
+        now = now or timezone.now()
+        if self.failing_since is None:
+            self.failing_since = now
+        self.consecutive_failures += 1
+        self.last_failure_at = now
+        self.last_latency = latency
+        self.last_error = str(error)[:1024]
+        
+        threshold = self.health_option('ENDPOINT_FAILURE_THRESHOLD', 5)
+        if self.consecutive_failures < threshold:
+            return
+        
+        ## Probing failing endpoint less and less often
+        backoff = self.health_option('ENDPOINT_PROBE_INTERVAL', 600) * 2 ** (self.consecutive_failures - threshold)
+        backoff = min(backoff, self.health_option('ENDPOINT_PROBE_MAX_INTERVAL', 86400))
+        self.next_probe_at = now + timedelta(seconds=backoff)
+        
+        ## Dead for long time
+        disable_after = self.health_option('ENDPOINT_DISABLE_AFTER', 30 * 86400)
+        if disable_after:
+            if (now - self.failing_since).total_seconds() > disable_after:
+                self.disabled = True
+    
+    @classmethod
+    async def aupdate_health(cls, results):
+        '''
+        Updates health stats of endpoints.
+        results: dict {uri: (error or None, latency or None)}
+        '''
+        now = timezone.now()
+        endpoints = []
+        async for endpoint in cls.objects.filter(uri__in=list(results)):
+            error, latency = results[endpoint.uri]
+            if error is None:
+                endpoint.record_success(latency, now)
+            else:
+                endpoint.record_failure(error, latency, now)
+            endpoints.append(endpoint)
+        
+        if endpoints:
+            await cls.objects.abulk_update(endpoints, [
+                'disabled', 'consecutive_failures', 'last_success_at', 'last_failure_at', 'failing_since',
+                'last_latency', 'last_error', 'next_probe_at'
+            ])
 
 class Activity(models.Model):
     class Meta:
@@ -57,13 +138,22 @@ class Activity(models.Model):
         (0,   'Unprocessed'),
         (10,   'Processing'),
         (20,         'Done'),
+        (30,       'Failed'),
+    )
+    
+    ## Thread root resolution stage
+    THREAD_STATUSES = (
+        (-1,     'Failed'),
+        (0,    'Resolved'),
+        (1,     'Pending'),
+        (2,   'Resolving'),
     )
     
     ts = models.DateTimeField('Timestamp', auto_now_add=True)
     uri = models.URLField('Activity URI', unique=True, null=False)
     activity_type = models.CharField('Type', choices=TYPES, max_length=3, null=False, default='', blank=True)
     object_type = models.CharField('Object Type', max_length=16, null=False, default='', blank=True)
-    actor_uri = models.URLField('Actor URI', null=False, default='', blank=True)
+    actor_uri = models.URLField('Actor URI', null=False, default='', blank=True, db_index=True)
     object_uri = models.URLField('Object URI', null=False, default='', blank=True, db_index=True)
     context = models.CharField('Context', null=False, default='', blank=True, max_length=255, db_index=True)
     in_reply_to_uri = models.URLField('In reply to', null=False, default='', blank=True)
@@ -83,6 +173,10 @@ class Activity(models.Model):
         'Processing status',
         default=0, null=False, blank=True
     )
+    thread_status = models.IntegerField('Thread status', choices=THREAD_STATUSES, default=0, null=False, db_index=True)
+    ## Worker processing the activity, claim is valid until claim_expires_at
+    claimed_by = models.CharField('Claimed by', max_length=64, null=False, default='', blank=True)
+    claim_expires_at = models.DateTimeField('Claim expires at', null=True, blank=True)
     _uniqid = None
     
     @property
@@ -203,3 +297,242 @@ class Follower(models.Model):
         if self.disabled:
             name = '[X] '
         return name + self.uri
+
+class Delivery(models.Model):
+    '''
+    Delivery of outgoing activity to one inbox.
+    '''
+    class Meta:
+        verbose_name_plural = 'Deliveries'
+        unique_together = [['activity', 'inbox']]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+    
+    STATUSES = (
+        (0,      'Pending'),
+        (10,  'Delivering'),
+        (20,   'Delivered'),
+        (30,      'Failed'),
+    )
+    
+    PENDING = 0
+    DELIVERING = 10
+    DELIVERED = 20
+    FAILED = 30
+    
+    activity = models.ForeignKey(Activity, null=False, on_delete=models.CASCADE, related_name='deliveries')
+    inbox = models.URLField('Inbox', null=False, max_length=255)
+    status = models.IntegerField('Status', choices=STATUSES, default=PENDING, null=False)
+    attempts = models.PositiveIntegerField('Attempts', default=0, null=False)
+    next_attempt_at = models.DateTimeField('Next attempt', default=timezone.now, null=False)
+    last_attempt_at = models.DateTimeField('Last attempt', null=True, blank=True)
+    last_error = models.TextField('Last error', default='', blank=True)
+    ## Worker sending the delivery, claim is valid until claim_expires_at
+    claimed_by = models.CharField('Claimed by', max_length=64, null=False, default='', blank=True)
+    claim_expires_at = models.DateTimeField('Claim expires at', null=True, blank=True)
+    
+    @staticmethod
+    def option(name, default):
+        return settings.MESSY_FEDIVERSE.get(name, default)
+    
+    def record_result(self, result, now=None):
+        '''
+        Update delivery from result of FediverseActor.deliver().
+        result: dict
+        '''
+        now = now or timezone.now()
+        self.claim_expires_at = None
+        
+        if result.get('blocked'):
+            ## Domain is blocked, not retrying
+            self.status = self.FAILED
+            self.last_error = str(result['error'])[:1024]
+            return
+        
+        if result['error'] is None:
+            self.status = self.DELIVERED
+            self.attempts += 1
+            self.last_attempt_at = now
+            self.last_error = ''
+            return
+        
+        self.status = self.PENDING
+        self.last_error = str(result['error'])[:1024]
+        
+        if not result['attempted']:
+            ## Request wasn't made (host is failing or asked to wait),
+            ## not counting it as attempt.
+            delay = self.option('DELIVERY_RETRY_BASE', 60)
+        else:
+            self.attempts += 1
+            self.last_attempt_at = now
+            if self.attempts >= self.option('DELIVERY_MAX_ATTEMPTS', 8):
+                self.status = self.FAILED
+                return
+            ## Exponential backoff
+            delay = min(
+                self.option('DELIVERY_RETRY_BASE', 60) * 2 ** (self.attempts - 1),
+                self.option('DELIVERY_RETRY_MAX', 6 * 3600)
+            )
+        
+        ## Jitter, so that retries to the same host don't come all at once
+        delay = delay * (0.5 + random())
+        self.next_attempt_at = now + timedelta(seconds=delay)
+    
+    def __str__(self):
+        status = dict(Delivery.STATUSES).get(self.status, '')
+        return f'[{status}] {self.inbox}'
+
+class IncomingActivity(models.Model):
+    '''
+    Activity received by inbox and waiting for processing by worker.
+    '''
+    class Meta:
+        verbose_name_plural = 'Incoming activities'
+    
+    STATUSES = (
+        (0,      'Queued'),
+        (10, 'Processing'),
+        (30,     'Failed'),
+    )
+    
+    QUEUED = 0
+    PROCESSING = 10
+    FAILED = 30
+    
+    received_at = models.DateTimeField('Received at', auto_now_add=True)
+    uri = models.URLField('Activity URI', null=False, default='', blank=True, max_length=255)
+    data = models.JSONField('Activity data', null=False, default=dict)
+    status = models.IntegerField('Status', choices=STATUSES, default=QUEUED, null=False, db_index=True)
+    attempts = models.PositiveIntegerField('Attempts', default=0, null=False)
+    last_error = models.TextField('Last error', default='', blank=True)
+    ## Worker processing the activity, claim is valid until claim_expires_at
+    claimed_by = models.CharField('Claimed by', max_length=64, null=False, default='', blank=True)
+    claim_expires_at = models.DateTimeField('Claim expires at', null=True, blank=True)
+    
+    def __str__(self):
+        status = dict(IncomingActivity.STATUSES).get(self.status, '')
+        return f'[{status}] {self.uri}'
+
+class RequestHeaders(models.Model):
+    '''
+    Full HTTP headers of inbox requests, kept for debugging only
+    (INBOX_DEBUG_HEADERS setting). Removed after INBOX_DEBUG_HEADERS_DAYS.
+    '''
+    class Meta:
+        verbose_name_plural = 'Request headers'
+    
+    received_at = models.DateTimeField('Received at', auto_now_add=True, db_index=True)
+    uri = models.URLField('Activity URI', null=False, default='', blank=True, max_length=255, db_index=True)
+    headers = models.JSONField('Headers', null=False, default=dict)
+    
+    @classmethod
+    def expire(cls, now=None):
+        '''
+        Removes old headers.
+        Returns number of removed rows.
+        '''
+        now = now or timezone.now()
+        days = settings.MESSY_FEDIVERSE.get('INBOX_DEBUG_HEADERS_DAYS', 3)
+        deleted, _ = cls.objects.filter(received_at__lt=now - timedelta(days=days)).delete()
+        return deleted
+    
+    def __str__(self):
+        return f'{self.received_at} {self.uri}'
+
+class BlockedDomain(models.Model):
+    '''
+    Remote instance we don't talk to.
+    '''
+    domain = models.CharField('Domain', max_length=255, unique=True, null=False,
+        help_text='For example "example.com" or "*.example.com"')
+    subdomains = models.BooleanField('Including subdomains', default=True, null=False)
+    reason = models.TextField('Reason', default='', blank=True)
+    created_at = models.DateTimeField('Created at', auto_now_add=True)
+    
+    def save(self, *args, **kwargs):
+        self.domain = self.domain.strip().lower().rstrip('.')
+        return super().save(*args, **kwargs)
+    
+    def __str__(self):
+        if self.subdomains and not self.domain.startswith('*.'):
+            return f'*.{self.domain}'
+        return self.domain
+
+class Worker(models.Model):
+    '''
+    Running or stopped worker process.
+    '''
+    worker_id = models.CharField('Worker ID', max_length=64, unique=True, null=False)
+    hostname = models.CharField('Host', max_length=255, null=False, default='', blank=True)
+    pid = models.IntegerField('PID', null=False, default=0)
+    started_at = models.DateTimeField('Started at', auto_now_add=True)
+    heartbeat_at = models.DateTimeField('Heartbeat', default=timezone.now, null=False, db_index=True)
+    stopped_at = models.DateTimeField('Stopped at', null=True, blank=True)
+    activities_done = models.PositiveBigIntegerField('Activities processed', default=0, null=False)
+    deliveries_done = models.PositiveBigIntegerField('Deliveries sent', default=0, null=False)
+    ## Average seconds between delivery due time and sending, since last heartbeat
+    delivery_lag = models.FloatField('Delivery lag', null=True, blank=True)
+    
+    def is_alive(self, now=None):
+        timeout = settings.MESSY_FEDIVERSE.get('WORKER_HEARTBEAT_TIMEOUT', 90)
+        return (
+            self.stopped_at is None
+            and ((now or timezone.now()) - self.heartbeat_at).total_seconds() < timeout
+        )
+    
+    @classmethod
+    def reap(cls, now=None):
+        '''
+        Returns jobs claimed by workers which stopped heartbeating back to queue.
+        Returns number of released (activities, deliveries).
+        '''
+        now = now or timezone.now()
+        timeout = settings.MESSY_FEDIVERSE.get('WORKER_HEARTBEAT_TIMEOUT', 90)
+        ## Forgetting long stopped workers
+        cls.objects.filter(stopped_at__lt=now - timedelta(days=7)).delete()
+        
+        dead = list(
+            cls.objects
+                .filter(stopped_at__isnull=True, heartbeat_at__lt=now - timedelta(seconds=timeout))
+                .values_list('worker_id', flat=True)
+        )
+        if not dead:
+            return 0, 0
+        
+        released = cls.release_claims(dead)
+        cls.objects.filter(worker_id__in=dead).update(stopped_at=now)
+        return released
+    
+    @staticmethod
+    def release_claims(worker_ids):
+        '''
+        Returns jobs claimed by workers back to queue.
+        worker_ids: list of worker IDs
+        Returns number of released (activities, deliveries).
+        '''
+        activities = (
+            Activity.objects
+                .filter(processing_status=10, claimed_by__in=worker_ids)
+                .update(processing_status=0, claim_expires_at=None)
+        )
+        activities += (
+            Activity.objects
+                .filter(thread_status=2, claimed_by__in=worker_ids)
+                .update(thread_status=1, claim_expires_at=None)
+        )
+        deliveries = (
+            Delivery.objects
+                .filter(status=Delivery.DELIVERING, claimed_by__in=worker_ids)
+                .update(status=Delivery.PENDING, claim_expires_at=None)
+        )
+        activities += (
+            IncomingActivity.objects
+                .filter(status=IncomingActivity.PROCESSING, claimed_by__in=worker_ids)
+                .update(status=IncomingActivity.QUEUED, claim_expires_at=None)
+        )
+        return activities, deliveries
+    
+    def __str__(self):
+        return self.worker_id
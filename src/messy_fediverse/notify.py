@@ -0,0 +1,305 @@
+'''
+Waking up worker when new activities are saved.
+Notifications may be lost (e.g. worker restarting), so worker
+still polls the database from time to time.
+'''
+import asyncio
+import socket
+import os
+from os import path
+from uuid import uuid4
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+from asgiref.sync import sync_to_async
+from .log import log_failure
+
+class Notifier:
+    '''
+    Base notifier, does nothing, so worker just polls.
+    '''
+    def __init__(self):
+        self._event = None
+    
+    @property
+    def listening(self):
+        return False
+    
+    async def notify(self):
+        '''
+        Wake up workers.
+        '''
+        pass
+    
+    async def start(self):
+        '''
+        Start listening for notifications (in worker).
+        '''
+        self._event = asyncio.Event()
+    
+    async def stop(self):
+        pass
+    
+    def wakeup(self):
+        if self._event is not None:
+            self._event.set()
+    
+    async def wait(self, timeout):
+        '''
+        Wait for notification.
+        timeout: float, seconds
+        Returns True if woken by notification.
+        '''
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._event.clear()
+
+class PostgresNotifier(Notifier):
+    '''
+    Uses PostgreSQL LISTEN/NOTIFY.
+    Requires psycopg (3) or psycopg2.
+    '''
+    def __init__(self, channel='messy_fediverse_worker'):
+        super().__init__()
+        self.channel = channel
+        self._conn = None
+        self._task = None
+    
+    @property
+    def listening(self):
+        return self._conn is not None
+    
+    async def notify(self):
+        await sync_to_async(self._notify)()
+    
+    def _notify(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, ''])
+    
+    def connection_params(self):
+        db = connection.settings_dict
+        params = {
+            key: value for key, value in db['OPTIONS'].items()
+            if key not in ('isolation_level', 'server_side_binding', 'assume_role', 'pool')
+        }
+        params['dbname'] = db['NAME']
+        for key, name in (('user', 'USER'), ('password', 'PASSWORD'), ('host', 'HOST'), ('port', 'PORT')):
+            if db.get(name):
+                params[key] = db[name]
+        return params
+    
+    async def start(self):
+        await super().start()
+        self._task = asyncio.create_task(self._listen())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _listen(self):
+        ## Reconnecting if connection lost
+        while True:
+            try:
+                try:
+                    import psycopg
+                except ImportError:
+                    await self._listen_psycopg2()
+                else:
+                    await self._listen_psycopg(psycopg)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_failure(f'LISTEN {self.channel} (polling instead)', e)
+            finally:
+                await self._close()
+            await asyncio.sleep(30)
+    
+    async def _close(self):
+        conn = self._conn
+        self._conn = None
+        if conn is not None:
+            result = conn.close()
+            if asyncio.iscoroutine(result):
+                await result
+    
+    async def _listen_psycopg(self, psycopg):
+        self._conn = await psycopg.AsyncConnection.connect(autocommit=True, **self.connection_params())
+        await self._conn.execute(f'LISTEN {self.channel}')
+        ## Work might be saved while we were not listening
+        self.wakeup()
+        async for notify in self._conn.notifies():
+            self.wakeup()
+    
+    async def _listen_psycopg2(self):
+        import psycopg2
+        import psycopg2.extensions
+        
+        self._conn = psycopg2.connect(**self.connection_params())
+        self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self._conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel}')
+        self.wakeup()
+        
+        loop = asyncio.get_running_loop()
+        lost = loop.create_future()
+        conn = self._conn
+        
+        def on_readable():
+            try:
+                conn.poll()
+            except Exception as e:
+                loop.remove_reader(conn.fileno())
+                if not lost.done():
+                    lost.set_exception(e)
+                return
+            if conn.notifies:
+                conn.notifies.clear()
+                self.wakeup()
+        
+        loop.add_reader(conn.fileno(), on_readable)
+        try:
+            await lost
+        finally:
+            if not conn.closed:
+                loop.remove_reader(conn.fileno())
+
+class SocketNotifier(Notifier):
+    '''
+    Uses unix datagram sockets in local directory,
+    for SQLite or MariaDB setups where worker runs on the same host.
+    Every worker binds own socket, notification is sent to all of them.
+    Directory should be seen by web server and worker (e.g. not in
+    private /tmp) and writable only by them, sockets are group writable.
+    '''
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self._sock = None
+        self._path = None
+    
+    @property
+    def listening(self):
+        return self._sock is not None
+    
+    async def notify(self):
+        ## Non blocking syscalls only
+        self._notify()
+    
+    def _notify(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.sock')]
+        except FileNotFoundError:
+            return
+        
+        if not names:
+            return
+        
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for name in names:
+                sock_path = path.join(self.directory, name)
+                try:
+                    sock.sendto(b'1', sock_path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    ## Left by dead worker
+                    try:
+                        os.unlink(sock_path)
+                    except OSError:
+                        pass
+                except BlockingIOError:
+                    ## Queue is full, so worker has notifications to read anyway
+                    pass
+                except PermissionError:
+                    pass
+    
+    async def start(self):
+        await super().start()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._path = path.join(self.directory, f'{uuid4().hex}.sock')
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(self._path)
+        except OSError as e:
+            log_failure(f'Listening on {self._path} (polling instead)', e)
+            return
+        
+        ## Web server may run as other user of same group
+        os.chmod(self._path, 0o770)
+        self._sock = sock
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+    
+    def _on_readable(self):
+        try:
+            while self._sock.recv(16):
+                pass
+        except BlockingIOError:
+            pass
+        self.wakeup()
+    
+    async def stop(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+__notifier__ = None
+
+def get_notifier():
+    '''
+    Get notifier configured by MESSY_FEDIVERSE['WORKER_NOTIFY']:
+    'auto' (default), 'postgresql', 'socket', 'polling' or dotted path to Notifier subclass.
+    Socket notifier requires MESSY_FEDIVERSE['WORKER_NOTIFY_SOCKET_DIR'],
+    'auto' uses it only if it's set.
+    '''
+    global __notifier__
+    if __notifier__ is not None:
+        return __notifier__
+    
+    backend = settings.MESSY_FEDIVERSE.get('WORKER_NOTIFY', 'auto') or 'polling'
+    socket_dir = settings.MESSY_FEDIVERSE.get('WORKER_NOTIFY_SOCKET_DIR')
+    if backend == 'auto':
+        if connection.vendor == 'postgresql':
+            backend = 'postgresql'
+        elif socket_dir:
+            backend = 'socket'
+        else:
+            backend = 'polling'
+    
+    if backend == 'socket' and not socket_dir:
+        log_failure('Socket notifier', ValueError('WORKER_NOTIFY_SOCKET_DIR is not set, polling instead'))
+        backend = 'polling'
+    
+    if backend == 'postgresql':
+        __notifier__ = PostgresNotifier()
+    elif backend == 'socket':
+        __notifier__ = SocketNotifier(socket_dir)
+    elif backend == 'polling':
+        __notifier__ = Notifier()
+    else:
+        __notifier__ = import_string(backend)()
+    
+    return __notifier__
+
+async def notify_worker():
+    '''
+    Wake up worker, errors are only logged.
+    '''
+    try:
+        await get_notifier().notify()
+    except Exception as e:
+        log_failure('Worker notification', e)
@@ -0,0 +1,380 @@
+import asyncio
+from time import monotonic
+from datetime import datetime, timezone
+from email import utils as emailutils
+from collections import OrderedDict
+
+class RateLimited(Exception):
+    '''
+    Raised when remote host asked us to wait longer than we can.
+    '''
+    pass
+
+class HostUnavailable(Exception):
+    '''
+    Raised when requests to host are suspended by circuit breaker.
+    '''
+    pass
+
+class HostBlocked(Exception):
+    '''
+    Raised when request to blocked domain is attempted.
+    '''
+    pass
+
+class ResponseTooLarge(Exception):
+    '''
+    Raised when response body exceeds allowed size.
+    '''
+    pass
+
+def parse_retry_after(value, default=None):
+    '''
+    Parse Retry-After header value.
+    value: string, seconds or HTTP date
+    Returns seconds to wait (float) or default.
+    '''
+    if not value:
+        return default
+    
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    
+    try:
+        date = emailutils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter.
+    rate: float, tokens per second
+    burst: int, bucket size
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = monotonic()
+    
+    def take(self):
+        '''
+        Take one token.
+        Returns 0 if token was taken, or seconds to wait for the next one.
+        '''
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class HostState:
+    def __init__(self, per_host, rate, burst):
+        self.semaphore = asyncio.Semaphore(per_host)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.blocked_until = 0
+        ## Requests holding or waiting for a slot
+        self.users = 0
+    
+    def idle(self):
+        return not self.users and self.blocked_until <= monotonic()
+
+class DeliveryScheduler:
+    '''
+    Limits concurrent requests globally and per host,
+    and rate of requests per host.
+    Should be used within one event loop.
+    '''
+    def __init__(self, concurrency=64, per_host=4, rate=5.0, burst=10, max_wait=60.0, maxhosts=4096):
+        '''
+        concurrency: int, max concurrent requests
+        per_host: int, max concurrent requests to one host
+        rate: float, requests per second to one host, 0 means no limit
+        burst: int, requests to one host allowed at once before rate applies
+        max_wait: float, max seconds to wait if host asked us to retry later,
+            request fails if it should wait longer.
+        maxhosts: int, max number of hosts to remember, idle ones are dropped first
+        '''
+        self.per_host = per_host
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.maxhosts = maxhosts
+        self.__semaphore__ = asyncio.Semaphore(concurrency)
+        self.__hosts__ = OrderedDict()
+        self.stats = {
+            'requests': 0,
+            'waited_rate': 0,
+            'waited_retry_after': 0,
+            'rate_limited': 0,
+            'deferred': 0,
+            'unlimited': 0,
+        }
+    
+    def host(self, hostname):
+        state = self.__hosts__.get(hostname)
+        if state is None:
+            state = HostState(self.per_host, self.rate, self.burst)
+            self.__hosts__[hostname] = state
+            if len(self.__hosts__) > self.maxhosts:
+                self.evict(keep=hostname)
+        else:
+            self.__hosts__.move_to_end(hostname)
+        return state
+    
+    def evict(self, keep=None):
+        '''
+        Drop least recently used idle hosts above maxhosts.
+        Hosts with requests in flight or asking to wait are kept.
+        keep: string, hostname not to drop
+        '''
+        excess = len(self.__hosts__) - self.maxhosts
+        for hostname, state in list(self.__hosts__.items()):
+            if excess <= 0:
+                break
+            if hostname != keep and state.idle():
+                del self.__hosts__[hostname]
+                excess -= 1
+    
+    def check(self, hostname):
+        '''
+        Check host without waiting for a slot, for requests which
+        shouldn't wait (e.g. made while handling HTTP request).
+        Concurrency and rate limits don't apply to them.
+        Raises RateLimited if host asked us to retry later.
+        '''
+        state = self.__hosts__.get(hostname)
+        wait = state.blocked_until - monotonic() if state is not None else 0
+        if wait > 0:
+            self.stats['rate_limited'] += 1
+            raise RateLimited(f'{hostname} asked to retry after {wait:.0f} seconds')
+        self.stats['unlimited'] += 1
+    
+    async def acquire(self, hostname):
+        '''
+        Wait for a slot to make request to host.
+        Raises RateLimited if host asked to wait longer than max_wait.
+        '''
+        state = self.host(hostname)
+        
+        wait = state.blocked_until - monotonic()
+        if wait > self.max_wait:
+            self.stats['rate_limited'] += 1
+            raise RateLimited(f'{hostname} asked to retry after {wait:.0f} seconds')
+        
+        state.users += 1
+        try:
+            if wait > 0:
+                self.stats['waited_retry_after'] += 1
+                await asyncio.sleep(wait)
+            
+            ## Host slot first, so that requests waiting for busy host
+            ## don't hold global slots.
+            await state.semaphore.acquire()
+            try:
+                if state.bucket is not None:
+                    wait = state.bucket.take()
+                    if wait:
+                        self.stats['waited_rate'] += 1
+                    while wait:
+                        await asyncio.sleep(wait)
+                        wait = state.bucket.take()
+                await self.__semaphore__.acquire()
+            except BaseException:
+                state.semaphore.release()
+                raise
+        except BaseException:
+            state.users -= 1
+            raise
+        
+        self.stats['requests'] += 1
+        return state
+    
+    def release(self, hostname, state=None):
+        '''
+        state: HostState returned by acquire()
+        '''
+        if state is None:
+            state = self.host(hostname)
+        self.__semaphore__.release()
+        state.semaphore.release()
+        state.users -= 1
+    
+    def defer(self, hostname, seconds):
+        '''
+        Don't make requests to host for some time (e.g. got 429 status).
+        '''
+        state = self.host(hostname)
+        state.blocked_until = max(state.blocked_until, monotonic() + seconds)
+        self.stats['deferred'] += 1
+
+class LatencyTracker:
+    '''
+    Rolling response latency estimate per host.
+    Keeps smoothed latency and its deviation like TCP does
+    for retransmission timeout (RFC 6298).
+    '''
+    def __init__(self, alpha=0.125, beta=0.25, maxsize=4096):
+        '''
+        alpha: float, smoothing factor for latency
+        beta: float, smoothing factor for latency deviation
+        maxsize: int, max number of hosts to remember
+        '''
+        self.alpha = alpha
+        self.beta = beta
+        self.maxsize = maxsize
+        ## hostname: [smoothed latency, deviation, samples count]
+        self.__hosts__ = OrderedDict()
+        self.stats = {
+            'samples': 0,
+            'timeouts': 0,
+        }
+    
+    def add(self, hostname, latency, timeout=False):
+        '''
+        Add latency sample (seconds).
+        timeout: bool, request timed out, latency is time we waited.
+        '''
+        state = self.__hosts__.get(hostname)
+        if state is None:
+            state = [latency, latency / 2, 0]
+            self.__hosts__[hostname] = state
+            if len(self.__hosts__) > self.maxsize:
+                self.__hosts__.popitem(last=False)
+        else:
+            self.__hosts__.move_to_end(hostname)
+            state[1] = (1 - self.beta) * state[1] + self.beta * abs(state[0] - latency)
+            state[0] = (1 - self.alpha) * state[0] + self.alpha * latency
+        state[2] += 1
+        self.stats['samples'] += 1
+        if timeout:
+            self.stats['timeouts'] += 1
+    
+    def estimate(self, hostname):
+        '''
+        Returns expected max latency of host (seconds) or None if host is unknown.
+        '''
+        state = self.__hosts__.get(hostname)
+        if state is None:
+            return None
+        return state[0] + 4 * state[1]
+    
+    def timeout(self, hostname, floor, ceiling, default=None):
+        '''
+        Returns timeout for host within [floor, ceiling],
+        or default if host is unknown.
+        '''
+        estimate = self.estimate(hostname)
+        if estimate is None:
+            return default
+        return min(ceiling, max(floor, estimate))
+
+class CircuitBreaker:
+    '''
+    Stops requests to hosts which fail repeatedly.
+    After `threshold` consecutive failures host is "open" for `cooldown` seconds,
+    then one more failure opens it again for twice longer (up to `max_cooldown`).
+    Any success closes it.
+    '''
+    def __init__(self, threshold=5, cooldown=30.0, max_cooldown=1800.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        ## hostname: [consecutive failures, open until, current cooldown]
+        self.__hosts__ = {}
+        self.stats = {
+            'opened': 0,
+            'rejected': 0,
+        }
+    
+    def check(self, hostname):
+        '''
+        Raises HostUnavailable if requests to host are suspended.
+        '''
+        state = self.__hosts__.get(hostname)
+        if state is None:
+            return
+        wait = state[1] - monotonic()
+        if wait > 0:
+            self.stats['rejected'] += 1
+            raise HostUnavailable(f'{hostname} is failing, requests suspended for {wait:.0f} seconds')
+    
+    def success(self, hostname):
+        self.__hosts__.pop(hostname, None)
+    
+    def failure(self, hostname):
+        state = self.__hosts__.get(hostname)
+        if state is None:
+            state = [0, 0, self.cooldown]
+            self.__hosts__[hostname] = state
+        state[0] += 1
+        if state[0] >= self.threshold:
+            state[1] = monotonic() + state[2]
+            state[2] = min(self.max_cooldown, state[2] * 2)
+            self.stats['opened'] += 1
+    
+    def open_hosts(self):
+        now = monotonic()
+        return [host for host, state in self.__hosts__.items() if state[1] > now]
+
+class DomainTrie:
+    '''
+    Set of domains stored by reversed labels (com -> example -> www),
+    so checking host and all its parent domains costs O(labels).
+    '''
+    def __init__(self, domains=()):
+        '''
+        domains: list of domains, subdomains match too
+        '''
+        self.__root__ = {}
+        self.size = 0
+        for domain in domains:
+            self.add(domain)
+    
+    def add(self, domain, subdomains=True):
+        '''
+        domain: string, "example.com" or "*.example.com"
+        subdomains: bool, match subdomains too
+        '''
+        domain = domain.strip().lower().rstrip('.')
+        if domain.startswith('*.'):
+            domain = domain[2:]
+            subdomains = True
+        if not domain:
+            return
+        
+        node = self.__root__
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        ## Empty string can't be a label, used as end mark
+        if '' not in node:
+            self.size += 1
+        node[''] = node.get('', False) or subdomains
+    
+    def match(self, host):
+        '''
+        Checks if host or its parent domain is in set.
+        '''
+        if not host:
+            return False
+        
+        labels = host.lower().rstrip('.').split('.')
+        last = len(labels) - 1
+        node = self.__root__
+        for n, label in enumerate(reversed(labels)):
+            node = node.get(label)
+            if node is None:
+                return False
+            if '' in node and (node[''] or n == last):
+                return True
+        return False
+    
+    def __len__(self):
+        return self.size